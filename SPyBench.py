@@ -0,0 +1,636 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+	Banc d'essai de SpyTREP
+
+	Usage :
+		python SPyBench.py memoire [joueurs=N]
+		python SPyBench.py charge [clients=N] [roster=N,N,...] [moteurs=web,brut] [workers=N,N,...] [processus=N]
+								  [duree=S] [timeout=S] [pause=S] [port=P] [srv.arg=valeur ...]
+
+	Modes :
+		memoire		: octets par joueur, avec l'ancienne classe Player dans un simple dico
+					  (un __dict__ par joueur, id et nom découpés, clefs non internées) et avec
+					  le registre actuel rempli par Serveur.add_player (liste des joueurs, index
+					  d'expiration et index de la page admin)
+		charge		: lance SPyTREP.py sur un port local et le fait tourner avec de vrais clients HTTP
+					  pendant duree secondes, pour chaque taille de roster demandée et chaque
+					  moteur HTTP (cf. l'argument moteur de SPyTREP) :
+						- clients joueurs (par paires) enchainent des échanges complets
+						  (connect, select, sent, update, valid, synchro, delete), avec 10% d'annulations
+						  (cancel) et 10% d'abandons (le joueur se tait jusqu'à son timeout)
+						- roster joueurs inactifs font un connect toutes les secondes
+					  Avec workers=0,2,4 chaque test est refait pour chaque nombre de workers du
+					  serveur (moteur web seulement). Les clients tournent dans processus
+					  processus (1 par défaut) : un seul processus Python sature avant le serveur.
+					  Résultats : requettes/s, latence p50/p99 par mode, temps CPU et RSS du serveur.
+					  Le temps CPU du processus qui détient l'état est donné à part, par requette :
+					  c'est la partie qui ne se répartit pas sur les workers, elle borne le débit
+					  (capacite_etat) quand il y a assez de workers et de processeurs.
+					  La latence vue par le serveur (histogramme de mode=metrics pendant le test)
+					  est donnée à côté : moyenne et borne de la classe qui contient la médiane.
+					  Les arguments srv.xxx=valeur sont passés au serveur (ex : srv.hold=5)
+
+	Les résultats sont écrits sur la sortie standard en JSON pour pouvoir comparer
+	les versions entre elles. (Le mode client est interne : un processus de charge.)
+'''
+
+import gc
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred, DeferredList
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.internet.protocol import Protocol
+from twisted.internet.task import deferLater
+
+import SPyTREP
+
+
+# Log des serveurs lancés dans ce processus dans un fichier (la sortie standard est réservée au résultat)
+LOG_CONF = '''[loggers]
+keys=root
+
+[handlers]
+keys=fileHandler
+
+[formatters]
+keys=simpleFormatter
+
+[logger_root]
+level=INFO
+handlers=fileHandler
+
+[handler_fileHandler]
+class=FileHandler
+level=INFO
+formatter=simpleFormatter
+args=('SPyTREP.log', 'a')
+
+[formatter_simpleFormatter]
+format=%(asctime)s %(levelname)-8s %(message)s
+'''
+
+
+class AncienPlayer:
+	'''Player tel qu'il était en 0.4 (sert de référence pour le mode memoire)'''
+
+	def __init__ (self,code):
+		self.id, self.name = code.split("_",1)
+		self.last_seen = time.time()
+		self.pkm = ""
+		self.friend = ""
+		self.ech = 0
+		self.ok  = 0
+		self.ca  = 0
+		self.syn = 0
+
+
+def deep_size(root):
+	'''Taille en octets de root et de tout ce qu'il référence (chaque objet compté une fois)'''
+	seen = set()
+	size = 0
+	stack = [root]
+	while stack:
+		obj = stack.pop()
+		if id(obj) in seen:
+			continue
+		seen.add(id(obj))
+		size += sys.getsizeof(obj)
+		if isinstance(obj, dict):
+			stack.extend(obj.keys())
+			stack.extend(obj.values())
+		elif isinstance(obj, (list, tuple, set, frozenset)):
+			stack.extend(obj)
+		if not isinstance(obj, (list, tuple, set, frozenset)):
+			# Aussi pour les dict dérivés (la liste chaînée d'un OrderedDict est dans son __dict__)
+			if hasattr(obj, '__dict__'):
+				stack.append(obj.__dict__)
+			for slot in getattr(type(obj), '__slots__', ()):
+				if hasattr(obj, slot):
+					stack.append(getattr(obj, slot))
+	return size
+
+
+def rss():
+	'''Mémoire résidente du processus en octets (Linux)'''
+	with open('/proc/self/statm') as statm:
+		return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def build(registry,variante,joueurs):
+	'''
+		Remplit le registre comme le ferait le serveur (codes reçus un par un) :
+		un dico d'AncienPlayer (avant) ou un Serveur via add_player (apres)
+	'''
+	for i in xrange(joueurs):
+		# "".join : chaîne neuve comme celles des requettes, jamais partagée d'office
+		code = "".join([str(i), "_", "joueur", str(i)])
+		if variante == 'avant':
+			registry[code] = AncienPlayer(code)
+		else:
+			registry.add_player(code)
+
+
+def registry(variante):
+	'''Registre vide (le Serveur est créé avant la mesure, seul son coût par joueur compte)'''
+	if variante == 'avant':
+		return {}
+	with open('log.cfg', 'w') as cfg:
+		cfg.write(LOG_CONF)
+	return SPyTREP.Serveur(log_conf='log.cfg', masterCode='banc')
+
+
+def registry_parts(registry):
+	'''Ce que le serveur garde par joueur'''
+	if isinstance(registry, dict):
+		return registry
+	return (registry.player_list, registry.expiry, registry.index)
+
+
+def measure(variante,joueurs):
+	'''Mesure une variante dans un processus fils pour que le RSS ne soit pas faussé par la précédente'''
+	read, write = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(read)
+		workdir = tempfile.mkdtemp(prefix='spybench')
+		os.chdir(workdir)
+		players = registry(variante)
+		gc.collect()
+		before = rss()
+		build(players, variante, joueurs)
+		after = rss()
+		result = {
+			'octets_par_joueur': deep_size(registry_parts(players)) / float(joueurs),
+			'rss_par_joueur': (after - before) / float(joueurs),
+		}
+		os.write(write, json.dumps(result))
+		shutil.rmtree(workdir, ignore_errors=True)
+		os._exit(0)
+	os.close(write)
+	data = []
+	while True:
+		chunk = os.read(read, 4096)
+		if not chunk:
+			break
+		data.append(chunk)
+	os.close(read)
+	os.waitpid(pid, 0)
+	return json.loads("".join(data))
+
+
+def memoire(joueurs=100000):
+	'''Mode memoire : octets par joueur avant/après'''
+	return {
+		'mode': 'memoire',
+		'joueurs': joueurs,
+		'avant': measure('avant', joueurs),
+		'apres': measure('apres', joueurs),
+	}
+
+
+def percentile(values,p):
+	'''Percentile p (entre 0 et 1) d'une liste triée'''
+	if not values:
+		return None
+	return values[int(p * (len(values) - 1))]
+
+
+def proc_stats(pid,fils=True):
+	'''Temps CPU (secondes) et RSS (octets) du processus pid et de ses fils directs (Linux)'''
+	cpu = 0.0
+	rss = 0
+	pids = [pid]
+	try:
+		with open('/proc/%d/task/%d/children' % (pid, pid)) as children:
+			if fils:
+				pids.extend([int(child) for child in children.read().split()])
+	except IOError:
+		pass
+	for p in pids:
+		try:
+			with open('/proc/%d/stat' % p) as stat:
+				fields = stat.read().rsplit(')', 1)[1].split()
+			cpu += (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+			with open('/proc/%d/status' % p) as status:
+				for line in status:
+					if line.startswith('VmRSS:'):
+						rss += int(line.split()[1]) * 1024
+		except IOError:
+			pass
+	return cpu, rss
+
+
+class Connexion(Protocol):
+	'''
+		Connexion HTTP/1.1 keep-alive du générateur de charge : une requette à la fois,
+		envoyée en une seule écriture avec TCP_NODELAY. Un client qui écrit les entêtes
+		puis le corps séparément (comme Agent + FileBodyProducer) attend l'ACK retardé du
+		serveur à cause de l'algorithme de Nagle : ~40 ms par requette sur la boucle locale.
+		Les réponses sont lues avec leur Content-Length ou en chunked.
+	'''
+	request_head = ("POST /index.php HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+					"Content-Type: application/x-www-form-urlencoded\r\nContent-Length: %d\r\n\r\n")
+
+	def connectionMade (self):
+		self.transport.setTcpNoDelay(True)
+		self.buffer = ""
+		self.pending = None
+		self.open = True
+
+	def request (self,body):
+		'''Envoie une requette POST, le Deferred reçoit le corps de la réponse'''
+		self.pending = Deferred()
+		self.transport.write(self.request_head % len(body) + body)
+		return self.pending
+
+	def dataReceived (self,data):
+		self.buffer += data
+		end = self.buffer.find("\r\n\r\n")
+		if end < 0 or self.pending is None:
+			return
+		lines = self.buffer[:end].lower().split("\r\n")
+		headers = dict([(name.strip(), value.strip()) for name, value in [line.split(":", 1) for line in lines[1:]]])
+		if headers.get('transfer-encoding') == 'chunked':
+			body = self.chunks(end + 4)
+			if body is None:
+				return
+			body, size = body
+		else:
+			size = end + 4 + int(headers.get('content-length', 0))
+			if len(self.buffer) < size:
+				return
+			body = self.buffer[end + 4:size]
+		self.buffer = self.buffer[size:]
+		if headers.get('connection') == 'close':
+			self.open = False
+		pending, self.pending = self.pending, None
+		pending.callback(body)
+
+	def chunks (self,start):
+		'''Décode un corps chunked complet : (corps, fin dans le buffer), None s'il manque la suite'''
+		body = []
+		while True:
+			end = self.buffer.find("\r\n", start)
+			if end < 0:
+				return None
+			length = int(self.buffer[start:end].split(";")[0], 16)
+			if len(self.buffer) < end + 2 + length + 2:
+				return None
+			if not length:
+				# Pas de trailers côté serveur : la fin est le CRLF qui suit le chunk vide
+				return "".join(body), end + 4
+			body.append(self.buffer[end + 2:end + 2 + length])
+			start = end + 2 + length + 2
+
+	def connectionLost (self,reason):
+		self.open = False
+		if self.pending is not None:
+			pending, self.pending = self.pending, None
+			pending.errback(reason)
+
+
+class Charge:
+	'''
+		Classe Charge
+			Description :
+				Générateur de charge : simule des clients qui suivent le vrai protocole
+				contre un SPyTREP lancé sur un port local et mesure les latences par mode
+
+			Liste des attributs :
+				endpoint	: Adresse du serveur
+				connexions	: Connexions libres (cf. Connexion), réutilisées d'une requette à l'autre
+				latencies	: Dico des latences (clefs = mode, valeurs = liste de secondes)
+				errors		: Dico des réponses d'erreur par mode
+				trades		: Compteurs d'échanges par scénario (complet, annule, abandon)
+				running		: Faux quand la durée du test est écoulée
+	'''
+
+	def __init__ (self,port,timeout,pause):
+		self.endpoint = TCP4ClientEndpoint(reactor, '127.0.0.1', port)
+		self.connexions = []
+		self.timeout = timeout
+		self.pause = pause
+		self.latencies = {}
+		self.errors = {}
+		self.trades = {'complet': 0, 'annule': 0, 'abandon': 0}
+		self.running = True
+
+	@inlineCallbacks
+	def post(self,mode,**args):
+		'''Envoie une requette POST et renvoie le corps de la réponse'''
+		args['mode'] = mode
+		body = urllib.urlencode(args)
+		start = time.time()
+		if self.connexions:
+			connexion = self.connexions.pop()
+		else:
+			connexion = yield connectProtocol(self.endpoint, Connexion())
+		data = yield connexion.request(body)
+		self.latencies.setdefault(mode, []).append(time.time() - start)
+		if connexion.open:
+			self.connexions.append(connexion)
+		if data.startswith("Requette"):
+			self.errors[mode] = self.errors.get(mode, 0) + 1
+		returnValue(data)
+
+	def close(self):
+		'''Ferme les connexions libres'''
+		for connexion in self.connexions:
+			connexion.transport.loseConnection()
+		self.connexions = []
+
+	@inlineCallbacks
+	def poll(self,mode,**args):
+		'''Répète une requette tant que la réponse est vide (comme le fait le jeu)'''
+		while self.running:
+			data = yield self.post(mode, **args)
+			if data != "":
+				returnValue(data)
+			yield deferLater(reactor, self.pause, lambda: None)
+		returnValue("")
+
+	@inlineCallbacks
+	def trader(self,me,other,scenario,leader):
+		'''Un joueur d'une paire : déroule un échange selon le scénario'''
+		codes = {'monCode': me, 'sonCode': other}
+		yield self.post('connect', monCode=me)
+		data = yield self.poll('select', **codes)
+		if data != "true":
+			returnValue(None)
+		if scenario == 'abandon' and leader:
+			# Le joueur disparait : le serveur doit le sortir par timeout
+			yield deferLater(reactor, self.timeout + 2, lambda: None)
+			returnValue(None)
+		if scenario == 'annule':
+			if leader:
+				yield self.post('cancel', **codes)
+				yield self.post('delete', monCode=me)
+			else:
+				yield self.poll('valid', **codes)
+				yield self.post('delete', monCode=me)
+			returnValue(None)
+		yield self.poll('sent', pokemon='pkm' * 64, **codes)
+		yield self.poll('update', **codes)
+		data = yield self.poll('valid', **codes)
+		if data == "true":
+			yield self.poll('synchro', **codes)
+		yield self.post('delete', monCode=me)
+
+	@inlineCallbacks
+	def pair(self,i):
+		'''Une paire de joueurs qui enchaine les échanges jusqu'à la fin du test'''
+		code_1 = "%d_banc%d" % (2 * i + 1, 2 * i + 1)
+		code_2 = "%d_banc%d" % (2 * i + 2, 2 * i + 2)
+		while self.running:
+			scenario = random.choice(['complet'] * 8 + ['annule', 'abandon'])
+			yield DeferredList([self.trader(code_1, code_2, scenario, True),
+								self.trader(code_2, code_1, scenario, False)])
+			self.trades[scenario] += 1
+
+	@inlineCallbacks
+	def idle(self,i):
+		'''Un joueur inactif qui rafraichit la liste des joueurs toutes les secondes'''
+		code = "%d_oisif%d" % (100000 + i, i)
+		yield deferLater(reactor, random.random(), lambda: None)
+		while self.running:
+			yield self.post('connect', monCode=code)
+			yield deferLater(reactor, 1, lambda: None)
+
+
+def wait_port(port,delay=10):
+	'''Attend que le serveur accepte les connexions'''
+	end = time.time() + delay
+	while time.time() < end:
+		try:
+			socket.create_connection(('127.0.0.1', port), 0.5).close()
+			return True
+		except socket.error:
+			time.sleep(0.1)
+	return False
+
+
+def server_metrics(port):
+	'''Histogrammes de latence du serveur (mode=metrics) : dico mode -> {borne (float) ou sum/count: valeur}'''
+	metrics = {}
+	page = urllib.urlopen("http://127.0.0.1:%d/index.php?mode=metrics&code=banc" % port).read()
+	for line in page.splitlines():
+		if line.startswith('spytrep_request_duration_seconds'):
+			name, value = line.rsplit(' ', 1)
+			labels = dict(re.findall(r'(\w+)="([^"]*)"', name))
+			key = float(labels['le']) if 'le' in labels else name.split('{')[0].rsplit('_', 1)[1]
+			metrics.setdefault(labels['mode'], {})[key] = float(value)
+	return metrics
+
+
+def server_latency(before,after):
+	'''Moyenne et borne de la classe médiane (ms) entre deux relevés de server_metrics'''
+	values = dict([(key, value - before.get(key, 0)) for key, value in after.items()])
+	count = values.get('count', 0)
+	if not count:
+		return None, None
+	for bound in sorted([key for key in values if key not in ('sum', 'count')]):
+		if values[bound] >= count / 2.0:
+			return values['sum'] / count * 1000, bound * 1000
+
+
+@inlineCallbacks
+def charge_client(port,pairs,roster,premier,debut,duree,timeout,pause):
+	'''
+		Un processus client : roster joueurs inactifs puis, de debut à debut + duree, pairs
+		paires de joueurs (numérotés à partir de premier pour ne pas croiser les autres processus)
+	'''
+	charge = Charge(port, timeout, pause)
+	for i in range(roster):
+		charge.idle(premier * roster + i)
+	# Le roster se remplit avant la mesure, qui commence au même moment dans tous les processus
+	yield deferLater(reactor, max(0, debut - time.time()), lambda: None)
+	charge.latencies = {}
+	charge.errors = {}
+	start = time.time()
+	actives = [charge.pair(premier * pairs + i) for i in range(pairs)]
+	yield deferLater(reactor, max(0, debut + duree - time.time()), lambda: None)
+	charge.running = False
+	elapsed = time.time() - start
+	yield DeferredList(actives)
+	charge.close()
+	returnValue({
+		'duree': elapsed,
+		'latences': charge.latencies,
+		'erreurs': charge.errors,
+		'echanges': charge.trades,
+	})
+
+
+def client(**options):
+	'''Mode client (interne) : lancé par charge_run, résultat brut en JSON sur la sortie standard'''
+	results = []
+	
+	@inlineCallbacks
+	def run():
+		try:
+			results.append((yield charge_client(**options)))
+		finally:
+			reactor.stop()
+	
+	reactor.callWhenRunning(run)
+	reactor.run()
+	return results[0]
+
+
+def charge_run(roster,moteur,workers,clients,processus,duree,timeout,pause,port,server_args):
+	'''Un test de charge complet pour une taille de roster, un moteur et un nombre de workers (serveur neuf)'''
+	workdir = tempfile.mkdtemp(prefix='spybench')
+	devnull = open(os.devnull, 'w')
+	server = subprocess.Popen([sys.executable, os.path.abspath(SPyTREP.__file__.replace('.pyc', '.py')),
+		'port=%d' % port, 'timeout=%d' % timeout, 'master_code=banc', 'moteur=' + moteur, 'workers=%d' % workers] + server_args,
+		cwd=workdir, stdout=devnull, stderr=devnull)
+	loaders = []
+	try:
+		if not wait_port(port):
+			raise RuntimeError("Le serveur ne demarre pas")
+		debut = time.time() + 2
+		for i in range(processus):
+			loaders.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), 'client', 'port=%d' % port,
+				'pairs=%d' % (clients // 2 // processus + (i < clients // 2 % processus)), 'roster=%d' % (roster // processus),
+				'premier=%d' % i, 'debut=%f' % debut, 'duree=%d' % duree, 'timeout=%d' % timeout, 'pause=%f' % pause],
+				cwd=workdir, stdout=subprocess.PIPE))
+		time.sleep(max(0, debut - time.time()))
+		cpu_start = proc_stats(server.pid)[0]
+		state_start = proc_stats(server.pid, False)[0]
+		metrics_start = server_metrics(port)
+		start = time.time()
+		time.sleep(duree)
+		elapsed = time.time() - start
+		cpu_end, rss = proc_stats(server.pid)
+		state_end = proc_stats(server.pid, False)[0]
+		metrics_end = server_metrics(port)
+		results = [json.loads(loader.communicate()[0]) for loader in loaders]
+	finally:
+		for loader in loaders:
+			if loader.poll() is None:
+				loader.kill()
+		server.terminate()
+		server.wait()
+		devnull.close()
+		shutil.rmtree(workdir, ignore_errors=True)
+
+	latencies = {}
+	trades = {}
+	for result in results:
+		for mode, values in result['latences'].items():
+			latencies.setdefault(mode, []).extend(values)
+		for scenario, count in result['echanges'].items():
+			trades[scenario] = trades.get(scenario, 0) + count
+	total = sum([len(values) for values in latencies.values()])
+	modes = {}
+	for mode, values in latencies.items():
+		values.sort()
+		mean, median = server_latency(metrics_start.get(mode, {}), metrics_end.get(mode, {}))
+		modes[mode] = {
+			'requettes': len(values),
+			'p50_ms': percentile(values, 0.50) * 1000,
+			'p99_ms': percentile(values, 0.99) * 1000,
+			'erreurs': sum([result['erreurs'].get(mode, 0) for result in results]),
+			'serveur_moyenne_ms': mean,
+			'serveur_p50_max_ms': median,
+		}
+	# Les clients mesurent la même fenêtre que le serveur à quelques ms près : on compare des débits
+	rate = total / max([result['duree'] for result in results])
+	state_us = (state_end - state_start) / elapsed / rate * 1e6 if rate else None
+	return {
+		'roster': roster,
+		'moteur': moteur,
+		'workers': workers,
+		'clients': clients,
+		'processus_clients': processus,
+		'duree': elapsed,
+		'requettes_par_seconde': rate,
+		'cpu_serveur_s': cpu_end - cpu_start,
+		'cpu_etat_s': state_end - state_start,
+		'cpu_etat_us_par_requette': state_us,
+		'capacite_etat_requettes_par_seconde': 1e6 / state_us if state_us else None,
+		'rss_serveur_octets': rss,
+		'echanges': trades,
+		'modes': modes,
+	}
+
+
+def charge(clients=20,roster=[0, 1000],moteurs=['web', 'brut'],workers=[0],processus=1,duree=10,timeout=10,pause=0.01,port=8765,server_args=[]):
+	'''Mode charge : un test par taille de roster, par moteur et par nombre de workers'''
+	results = []
+	for size in roster:
+		for moteur in moteurs:
+			for count in workers:
+				# Les workers servent toujours avec twisted.web (cf. SPyTREP.main)
+				if count and moteur != 'web':
+					continue
+				results.append(charge_run(size, moteur, count, clients, processus, duree, timeout, pause, port, server_args))
+	return {
+		'mode': 'charge',
+		'python': sys.version.split()[0],
+		'processeurs': multiprocessing.cpu_count(),
+		'arguments_serveur': server_args,
+		'resultats': results,
+	}
+
+
+def main():
+	if len(sys.argv) < 2 or sys.argv[1] not in ['memoire', 'charge', 'client']:
+		print __doc__
+		sys.exit(1)
+
+	options = {}
+	server_args = []
+	mode_charge = sys.argv[1] == 'charge'
+	for arg in sys.argv[2:]:
+		var = arg.split('=',1)
+		if len(var) != 2:
+			print "Argument Invalide !", arg
+		elif sys.argv[1] == 'client':
+			# Arguments passés par charge_run
+			options[var[0]] = float(var[1]) if var[0] in ['debut', 'pause'] else int(var[1])
+		elif var[0] == 'joueurs' and not mode_charge and var[1].isdigit():
+			options['joueurs'] = int(var[1])
+		elif not mode_charge:
+			# Les autres arguments ne concernent que le mode charge
+			print "Argument Invalide !", arg
+		elif var[0].startswith('srv.'):
+			server_args.append(arg[4:])
+		elif var[0] in ['clients', 'processus', 'duree', 'timeout', 'port'] and var[1].isdigit():
+			options[var[0]] = int(var[1])
+		elif var[0] == 'pause' and var[1].replace('.','',1).isdigit():
+			options['pause'] = float(var[1])
+		elif var[0] == 'roster':
+			options['roster'] = [int(size) for size in var[1].split(',') if size.isdigit()]
+		elif var[0] == 'moteurs':
+			options['moteurs'] = [moteur for moteur in var[1].split(',') if moteur in ['web', 'brut']]
+		elif var[0] == 'workers':
+			options['workers'] = [int(count) for count in var[1].split(',') if count.isdigit()]
+		else:
+			print "Argument Invalide !", arg
+
+	if sys.argv[1] == 'memoire':
+		result = memoire(**options)
+	elif sys.argv[1] == 'client':
+		result = client(**options)
+	else:
+		result = charge(server_args=server_args, **options)
+	print json.dumps(result, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+	Lecture du journal des échanges de SpyTREP (argument journal=fichier du serveur)
+
+	Usage :
+		python SPyJournal.py fichier [joueur=ID] [evenement=nom,nom,...] [depuis=date] [jusqua=date] [verifie=true] [sortie=texte|stats]
+
+	Arguments :
+		joueur		: ne garde que les événements où ID est le joueur ou son partenaire
+		evenement	: ne garde que ces événements (demande, accepte, envoi, valide, synchro, annule, timeout)
+		depuis		: date de début (timestamp ou AAAA-MM-JJTHH:MM:SS)
+		jusqua		: date de fin (même format)
+		verifie		: vérifie le crc32 de chaque enregistrement
+		sortie		: texte (un événement par ligne, par défaut) ou stats (compteurs par
+					  événement, période couverte et vitesse de lecture, en JSON)
+'''
+
+import json
+import sys
+import time
+
+from SPyTREP import Journal
+
+
+def parse_date(text):
+	'''Timestamp ou date AAAA-MM-JJTHH:MM:SS (heure locale)'''
+	try:
+		return float(text)
+	except ValueError:
+		return time.mktime(time.strptime(text, '%Y-%m-%dT%H:%M:%S'))
+
+
+def scan(path,joueur=None,evenements=None,depuis=None,jusqua=None,verifie=False):
+	'''Itère sur les enregistrements du journal qui passent les filtres'''
+	for record in Journal.read(path, verifie):
+		if depuis is not None and record[0] < depuis:
+			continue
+		if jusqua is not None and record[0] > jusqua:
+			continue
+		if evenements is not None and record[1] not in evenements:
+			continue
+		if joueur is not None and record[3] != joueur and record[5] != joueur:
+			continue
+		yield record
+
+
+def texte(records):
+	'''Un événement par ligne'''
+	events = Journal.events
+	for now, event, size, id, name, partner_id, partner_name in records:
+		line = "%s.%03d %-8s %s (%s) -> %s (%s)" % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)), int(now * 1000) % 1000,
+			events[event], name, id, partner_name, partner_id)
+		if size:
+			line += " %s octets" % size
+		print line
+
+
+def stats(records):
+	'''Compteurs par événement, période couverte et vitesse de lecture'''
+	start = time.time()
+	counts = [0] * len(Journal.events)
+	first = last = None
+	total = 0
+	for record in records:
+		counts[record[1]] += 1
+		if first is None:
+			first = record[0]
+		last = record[0]
+		total += 1
+	elapsed = time.time() - start
+	return {
+		'enregistrements': total,
+		'evenements': dict(zip(Journal.events, counts)),
+		'debut': first,
+		'fin': last,
+		'lecture_s': elapsed,
+		'enregistrements_par_seconde': total / elapsed if elapsed else None,
+	}
+
+
+def main():
+	if len(sys.argv) < 2 or '=' in sys.argv[1]:
+		print __doc__
+		sys.exit(1)
+
+	options = {}
+	sortie = 'texte'
+	for arg in sys.argv[2:]:
+		var = arg.split('=',1)
+		if len(var) != 2:
+			print "Argument Invalide !", arg
+		elif var[0] == 'joueur' and var[1].isdigit():
+			options['joueur'] = int(var[1])
+		elif var[0] == 'evenement':
+			options['evenements'] = set([Journal.events.index(event) for event in var[1].split(',') if event in Journal.events])
+		elif var[0] in ['depuis', 'jusqua']:
+			options[var[0]] = parse_date(var[1])
+		elif var[0] == 'verifie' and var[1] in ['true', 'false']:
+			options['verifie'] = var[1] == 'true'
+		elif var[0] == 'sortie' and var[1] in ['texte', 'stats']:
+			sortie = var[1]
+		else:
+			print "Argument Invalide !", arg
+
+	records = scan(sys.argv[1], **options)
+	if sortie == 'stats':
+		print json.dumps(stats(records), indent=2, sort_keys=True)
+	else:
+		texte(records)
+
+
+if __name__ == '__main__':
+	main()
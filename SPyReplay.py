@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+	Rejoue une capture du trafic de SpyTREP (argument capture=fichier du serveur)
+
+	Usage :
+		python SPyReplay.py fichier [vitesse=N] [timeout=S] [sweep=S] [check_auto=true|false] [exemples=N]
+
+	Arguments :
+		vitesse		: 1 à 100 fois la vitesse de la capture (1 par défaut), 0 = au plus vite
+		timeout		: timeout du serveur capturé (60 par défaut), divisé par la vitesse pour
+					  que les joueurs silencieux expirent au même moment de la trace
+		sweep		: période de vérification des timeouts du serveur capturé (1 par défaut),
+					  divisée par la vitesse elle aussi
+		check_auto	: même réglage que le serveur capturé
+		exemples	: nombre de différences détaillées dans le résultat (10 par défaut)
+
+	Les requettes sont rejouées dans l'ordre, à leur date d'arrivée (ramenée à la vitesse
+	demandée), sur un Serveur neuf dans ce processus : la latence mesurée est celle de
+	render_GET/render_POST sans le HTTP. Chaque réponse est comparée à celle capturée
+	(code HTTP et crc32 du corps avant compression). Ne sont pas comparées :
+		- les requettes mises en attente (long-poll) : le rejeu se fait sans maintien
+		  et leur réponse dépend du moment où le partenaire a bougé
+		- les 304 de la page publique : les entêtes du client ne sont pas capturés
+	Avec vitesse=0 aucun joueur n'expire pendant le rejeu. Les réponses qui suivent de
+	près un timeout peuvent différer : l'expiration n'est précise qu'à sweep près.
+
+	Le résultat (requettes/s, latence p50/p99 par mode, différences) est écrit sur la
+	sortie standard en JSON.
+'''
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+from twisted.internet import reactor
+
+from SPyTREP import Capture, Requete, Serveur
+from SPyBench import LOG_CONF, percentile
+
+
+class Rejeu:
+	'''
+		Classe Rejeu
+			Description :
+				Envoie les requettes d'une capture à un Serveur neuf en respectant leur
+				espacement (divisé par la vitesse) et compare les réponses
+
+			Liste des attributs :
+				serveur		: Serveur qui reçoit les requettes
+				records		: Itérateur sur les requettes de la capture
+				vitesse		: Facteur de vitesse (0 = au plus vite)
+				latencies	: Latences par mode (clefs = mode, valeurs = liste de secondes)
+				differences	: Nombre de réponses différentes par mode
+				identiques	: Nombre de réponses identiques
+				ignorees	: Nombre de réponses non comparées (long-poll, 304)
+				exemples	: Détail des premières différences
+				done		: Appelé à la fin de la trace
+	'''
+
+	def __init__ (self,serveur,records,vitesse,exemples,done):
+		self.serveur = serveur
+		self.records = records
+		self.vitesse = vitesse
+		self.max_exemples = exemples
+		self.done = done
+		self.latencies = {}
+		self.differences = {}
+		self.identiques = 0
+		self.ignorees = 0
+		self.exemples = []
+		self.first = None
+		self.last = None
+		self.start = None
+		self.pending = next(self.records, None)
+
+	def step (self):
+		'''Rejoue toutes les requettes arrivées à échéance puis attend la suivante'''
+		now = time.time()
+		if self.start is None:
+			self.start = now
+		while self.pending is not None:
+			if self.first is None:
+				self.first = self.pending[0]
+			if self.vitesse:
+				delay = self.start + (self.pending[0] - self.first) / self.vitesse - time.time()
+				if delay > 0:
+					reactor.callLater(delay, self.step)
+					return
+			self.play(self.pending)
+			self.last = self.pending[0]
+			self.pending = next(self.records, None)
+			if not self.vitesse and time.time() - now > 0.1:
+				# Au plus vite : on rend quand même la main au reactor (timeouts, logs)
+				reactor.callLater(0, self.step)
+				return
+		self.done()
+
+	def play (self,record):
+		'''Rejoue une requette et compare sa réponse à celle capturée'''
+		now, method, args, ip, code, size, crc, body, parked = record
+		args = dict(args)
+		args.pop('attente', None)
+		requete = Requete(None, method, args, {}, ip, lambda requete: None)
+		mode = args.get('mode', [''])[0] if method == 'POST' else 'page'
+		start = time.time()
+		if method == 'POST':
+			ret = self.serveur.render_POST(requete)
+		else:
+			ret = self.serveur.render_GET(requete)
+		self.latencies.setdefault(mode, []).append(time.time() - start)
+		if parked or code == 304:
+			self.ignorees += 1
+		elif requete.code == code and zlib.crc32(ret) & 0xffffffff == crc and len(ret) == size:
+			self.identiques += 1
+		else:
+			self.differences[mode] = self.differences.get(mode, 0) + 1
+			if len(self.exemples) < self.max_exemples:
+				self.exemples.append({
+					'date': now - self.first,
+					'methode': method,
+					'arguments': args,
+					'attendu': [code, body if body is not None else "%s octets, crc32 %08x" % (size, crc)],
+					'obtenu': [requete.code, ret],
+				})
+
+	def result (self):
+		elapsed = time.time() - self.start if self.start else 0
+		total = sum([len(values) for values in self.latencies.values()])
+		modes = {}
+		for mode, values in self.latencies.items():
+			values.sort()
+			modes[mode] = {
+				'requettes': len(values),
+				'p50_ms': percentile(values, 0.50) * 1000,
+				'p99_ms': percentile(values, 0.99) * 1000,
+				'differences': self.differences.get(mode, 0),
+			}
+		return {
+			'vitesse': self.vitesse,
+			'requettes': total,
+			'duree_capture': self.last - self.first if self.first is not None else 0,
+			'duree': elapsed,
+			'requettes_par_seconde': total / elapsed if elapsed else None,
+			'identiques': self.identiques,
+			'differences': sum(self.differences.values()),
+			'non_comparees': self.ignorees,
+			'modes': modes,
+			'exemples': self.exemples,
+		}
+
+
+def replay(path,vitesse=1.0,timeout=60,sweep=1,check_auto=False,exemples=10):
+	'''Rejoue la capture path sur un Serveur neuf (lancé dans un dossier temporaire)'''
+	records = Capture.read(os.path.abspath(path))
+	workdir = tempfile.mkdtemp(prefix='spyreplay')
+	cwd = os.getcwd()
+	os.chdir(workdir)
+	try:
+		with open('log.cfg', 'w') as cfg:
+			cfg.write(LOG_CONF)
+		if vitesse:
+			timeout = float(timeout) / vitesse
+			sweep = float(sweep) / vitesse
+		serveur = Serveur(timeout, 'log.cfg', check_auto, 'rejeu', sweep)
+		rejeu = Rejeu(serveur, records, vitesse, exemples, reactor.stop)
+		reactor.callWhenRunning(rejeu.step)
+		reactor.run()
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(workdir, ignore_errors=True)
+	result = rejeu.result()
+	result['trace'] = path
+	result['timeout'] = timeout
+	return result
+
+
+def main():
+	if len(sys.argv) < 2 or '=' in sys.argv[1]:
+		print __doc__
+		sys.exit(1)
+
+	options = {}
+	for arg in sys.argv[2:]:
+		var = arg.split('=',1)
+		if len(var) != 2:
+			print "Argument Invalide !", arg
+		elif var[0] == 'vitesse' and var[1].replace('.','',1).isdigit() and float(var[1]) <= 100:
+			options['vitesse'] = float(var[1])
+		elif var[0] in ['timeout', 'sweep', 'exemples'] and var[1].isdigit():
+			options[var[0]] = int(var[1])
+		elif var[0] == 'check_auto' and var[1] in ['true', 'false']:
+			options['check_auto'] = var[1] == 'true'
+		else:
+			print "Argument Invalide !", arg
+
+	print json.dumps(replay(sys.argv[1], **options), indent=2, sort_keys=True, encoding='latin-1')
+
+
+if __name__ == '__main__':
+	main()
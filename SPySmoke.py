@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+	Tests de fumée de SpyTREP : les chemins principaux en quelques secondes
+
+	Usage :
+		python SPySmoke.py [port=P]
+
+	Vérifications :
+		echange		: échange complet entre deux joueurs (connect, select, sent, update, valid,
+					  synchro, delete), annulation et requette invalide, sur un Serveur dans ce processus
+		roster		: deltas de la liste des joueurs (connect avec version : unchanged, delta,
+					  full, même entrée de cache pour "3" et "003")
+		passation	: mise à jour sans coupure : un second SPyTREP.py reprend la socket d'écoute
+					  et les joueurs du premier, qui s'arrête ; sans passation un port pris fait
+					  sortir en erreur (port P)
+		brut		: moteur=brut : codes d'erreur (400, 404, 413, 431, 501), corps chunked, HEAD
+					  et requettes enchainées sur une connexion (port P+1)
+
+	Chaque vérification affiche ok ou les différences constatées, le code de sortie
+	est le nombre de vérifications en échec.
+'''
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib
+
+import SPyTREP
+from SPyBench import LOG_CONF, wait_port
+
+
+class Verification:
+	'''
+		Classe Verification
+			Description :
+				Résultat d'une vérification : liste des différences constatées
+
+			Liste des attributs :
+				nom			: Nom de la vérification
+				erreurs		: Différences constatées (vide = ok)
+	'''
+
+	def __init__ (self,nom):
+		self.nom = nom
+		self.erreurs = []
+
+	def egal (self,quoi,obtenu,attendu):
+		if obtenu != attendu:
+			self.erreurs.append("%s : %r au lieu de %r" % (quoi, obtenu, attendu))
+
+	def vrai (self,quoi,condition):
+		if not condition:
+			self.erreurs.append(quoi)
+
+
+def post(serveur,**args):
+	'''Requette POST sur un Serveur de ce processus (comme SPyReplay, sans le HTTP)'''
+	requete = SPyTREP.Requete(None, 'POST', dict([(name, [value]) for name, value in args.items()]), {}, '127.0.0.1', lambda requete: None)
+	return serveur.render_POST(requete)
+
+
+def echange(v,serveur):
+	a, b = "1_Sacha", "2_Ondine"
+	v.egal("connect a", post(serveur, mode='connect', monCode=a), str([a]))
+	v.vrai("connect b : liste sans les deux joueurs", sorted(eval(post(serveur, mode='connect', monCode=b))) == [a, b])
+	v.egal("select a (attend b)", post(serveur, mode='select', monCode=a, sonCode=b), "")
+	v.egal("select b", post(serveur, mode='select', monCode=b, sonCode=a), "true")
+	v.egal("select a", post(serveur, mode='select', monCode=a, sonCode=b), "true")
+	v.egal("sent a (attend b)", post(serveur, mode='sent', monCode=a, sonCode=b, pokemon='pkm_a'), "")
+	v.egal("sent b", post(serveur, mode='sent', monCode=b, sonCode=a, pokemon='pkm_b'), "pkm_a")
+	v.egal("update a", post(serveur, mode='update', monCode=a, sonCode=b), "pkm_b")
+	v.egal("valid a (attend b)", post(serveur, mode='valid', monCode=a, sonCode=b), "")
+	v.egal("valid b", post(serveur, mode='valid', monCode=b, sonCode=a), "true")
+	v.egal("valid a", post(serveur, mode='valid', monCode=a, sonCode=b), "true")
+	v.egal("synchro a (attend b)", post(serveur, mode='synchro', monCode=a, sonCode=b), "")
+	v.egal("synchro b", post(serveur, mode='synchro', monCode=b, sonCode=a), "true")
+	v.egal("synchro a", post(serveur, mode='synchro', monCode=a, sonCode=b), "true")
+	v.egal("delete a", post(serveur, mode='delete', monCode=a), "")
+	v.egal("delete b", post(serveur, mode='delete', monCode=b), "")
+	v.egal("joueurs après delete", len(serveur.player_list), 0)
+
+	c, d = "3_Pierre", "4_Flora"
+	post(serveur, mode='connect', monCode=c)
+	post(serveur, mode='connect', monCode=d)
+	post(serveur, mode='select', monCode=c, sonCode=d)
+	post(serveur, mode='select', monCode=d, sonCode=c)
+	v.egal("cancel c", post(serveur, mode='cancel', monCode=c, sonCode=d), "true")
+	v.egal("valid d après cancel", post(serveur, mode='valid', monCode=d, sonCode=c), "false")
+	v.vrai("sent sans pokemon accepté", post(serveur, mode='sent', monCode=c, sonCode=d).startswith("Requette"))
+	v.vrai("mode inconnu accepté", post(serveur, mode='inconnu', monCode=c).startswith("Requette"))
+	post(serveur, mode='delete', monCode=c)
+	post(serveur, mode='delete', monCode=d)
+
+
+def roster(v,serveur):
+	post(serveur, mode='connect', monCode="10_Red")
+	version = serveur.roster_version
+	v.egal("même version", post(serveur, mode='connect', monCode="10_Red", version=str(version)), "%d\nunchanged" % version)
+	post(serveur, mode='connect', monCode="11_Blue")
+	post(serveur, mode='delete', monCode="10_Red")
+	attendu = "%d\ndelta\n%s\n%s" % (serveur.roster_version, ['11_Blue'], ['10_Red'])
+	v.egal("delta", post(serveur, mode='connect', monCode="11_Blue", version=str(version)), attendu)
+	v.egal("version avec des zéros", post(serveur, mode='connect', monCode="11_Blue", version="00" + str(version)), attendu)
+	v.egal("une entrée de cache par version", serveur.roster_deltas.keys().count(version), 1)
+	v.egal("version invalide", post(serveur, mode='connect', monCode="11_Blue", version="abc"), "%d\nfull\n%s" % (serveur.roster_version, ['11_Blue']))
+	v.egal("version future", post(serveur, mode='connect', monCode="11_Blue", version=str(serveur.roster_version + 5)).split("\n")[1], "full")
+	post(serveur, mode='delete', monCode="11_Blue")
+
+
+def lance(workdir,*args):
+	'''Lance SPyTREP.py dans workdir (log dans un fichier)'''
+	devnull = open(os.devnull, 'w')
+	try:
+		return subprocess.Popen([sys.executable, os.path.abspath(SPyTREP.__file__.replace('.pyc', '.py')), 'master_code=smoke'] + list(args),
+			cwd=workdir, stdout=devnull, stderr=devnull)
+	finally:
+		devnull.close()
+
+
+def connect(port,code):
+	return urllib.urlopen("http://127.0.0.1:%d/index.php" % port, urllib.urlencode({'mode': 'connect', 'monCode': code})).read()
+
+
+def passation(v,workdir,port):
+	sock = os.path.join(workdir, 'passation.sock')
+	ancien = lance(workdir, 'port=%d' % port, 'passation=' + sock)
+	nouveau = None
+	try:
+		v.vrai("l'ancien serveur ne démarre pas", wait_port(port))
+		connect(port, "20_Brock")
+		nouveau = lance(workdir, 'port=%d' % port, 'passation=' + sock)
+		fin = time.time() + 15
+		while ancien.poll() is None and time.time() < fin:
+			time.sleep(0.1)
+		v.egal("code de sortie de l'ancien", ancien.poll(), 0)
+		v.vrai("joueur perdu à la passation", "20_Brock" in connect(port, "21_Misty"))
+		v.egal("nouveau serveur toujours là", nouveau.poll(), None)
+		# Sans passation le port pris est une erreur propre (pas de traceback)
+		occupe = lance(workdir, 'port=%d' % port)
+		v.egal("code de sortie sur un port pris", occupe.wait(), 1)
+	finally:
+		for process in (ancien, nouveau):
+			if process is not None and process.poll() is None:
+				process.terminate()
+				process.wait()
+
+
+def brut_requette(port,data,attente=1.0):
+	'''Envoie data tel quel et renvoie tout ce que le serveur répond avant de fermer (ou attente secondes)'''
+	client = socket.create_connection(('127.0.0.1', port))
+	client.settimeout(attente)
+	client.sendall(data)
+	reponse = []
+	try:
+		while True:
+			morceau = client.recv(65536)
+			if not morceau:
+				break
+			reponse.append(morceau)
+	except socket.timeout:
+		pass
+	client.close()
+	return "".join(reponse)
+
+
+def reponses(data,head=False):
+	'''Découpe les réponses reçues (Content-Length) : liste de (code, entêtes, corps)'''
+	resultat = []
+	while data:
+		end = data.find("\r\n\r\n")
+		if end < 0:
+			break
+		lines = data[:end].split("\r\n")
+		entetes = dict([(name.strip().lower(), value.strip()) for name, value in [line.split(":", 1) for line in lines[1:]]])
+		longueur = 0 if head else int(entetes.get('content-length', 0))
+		resultat.append((int(lines[0].split()[1]), entetes, data[end + 4:end + 4 + longueur]))
+		data = data[end + 4 + longueur:]
+	return resultat
+
+
+def statuts(data):
+	return [code for code, entetes, corps in reponses(data)]
+
+
+def brut(v,workdir,port):
+	serveur = lance(workdir, 'port=%d' % port, 'moteur=brut')
+	try:
+		v.vrai("le serveur ne démarre pas", wait_port(port))
+		entetes = "Host: smoke\r\nContent-Type: application/x-www-form-urlencoded\r\n"
+		corps = "mode=connect&monCode=30_Giovanni"
+		v.egal("mauvaise ligne de requette", statuts(brut_requette(port, "n'importe quoi\r\n\r\n")), [400])
+		v.egal("mauvais Content-Length", statuts(brut_requette(port, "POST /index.php HTTP/1.1\r\nContent-Length: x\r\n\r\n")), [400])
+		v.egal("autre chemin", statuts(brut_requette(port, "GET /autre HTTP/1.1\r\nHost: smoke\r\nConnection: close\r\n\r\n")), [404])
+		v.egal("corps trop gros", statuts(brut_requette(port, "POST /index.php HTTP/1.1\r\nContent-Length: 1000000\r\n\r\n")), [413])
+		v.egal("entêtes trop gros", statuts(brut_requette(port, "GET /index.php HTTP/1.1\r\nX: " + "x" * 10000)), [431])
+		v.egal("Transfer-Encoding inconnu", statuts(brut_requette(port, "POST /index.php HTTP/1.1\r\nTransfer-Encoding: gzip\r\n\r\n")), [501])
+		v.egal("méthode inconnue", statuts(brut_requette(port, "PUT /index.php HTTP/1.1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")), [501])
+		v.egal("chunk mal formé", statuts(brut_requette(port, "POST /index.php HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n")), [400])
+
+		# Corps chunked suivi d'une seconde requette sur la même connexion
+		chunked = "%x\r\n%s\r\n%x\r\n%s\r\n0\r\n\r\n" % (10, corps[:10], len(corps) - 10, corps[10:])
+		reponse = brut_requette(port, "POST /index.php HTTP/1.1\r\n" + entetes + "Transfer-Encoding: chunked\r\n\r\n" + chunked +
+			"POST /index.php HTTP/1.1\r\n" + entetes + "Content-Length: %d\r\nConnection: close\r\n\r\n%s" % (len(corps), corps))
+		v.egal("chunked puis keep-alive", statuts(reponse), [200, 200])
+		v.egal("corps chunked décodé", [corps for code, entetes, corps in reponses(reponse)], [str(['30_Giovanni'])] * 2)
+
+		# HEAD : mêmes entêtes que GET, sans le corps
+		get = brut_requette(port, "GET /index.php HTTP/1.1\r\nHost: smoke\r\nConnection: close\r\n\r\n")
+		head = brut_requette(port, "HEAD /index.php HTTP/1.1\r\nHost: smoke\r\nConnection: close\r\n\r\n")
+		v.egal("HEAD", [code for code, entetes, corps in reponses(head, True)], [200])
+		v.vrai("HEAD renvoie un corps", head.endswith("\r\n\r\n"))
+		v.egal("Content-Length de HEAD", reponses(head, True)[0][1].get('content-length'), reponses(get)[0][1].get('content-length'))
+	finally:
+		serveur.terminate()
+		serveur.wait()
+
+
+def main():
+	options = {'port': 8790}
+	for arg in sys.argv[1:]:
+		var = arg.split('=',1)
+		if len(var) == 2 and var[0] == 'port' and var[1].isdigit():
+			options['port'] = int(var[1])
+		else:
+			print "Argument Invalide !", arg
+
+	workdir = tempfile.mkdtemp(prefix='spysmoke')
+	cwd = os.getcwd()
+	os.chdir(workdir)
+	try:
+		with open('log.cfg', 'w') as cfg:
+			cfg.write(LOG_CONF)
+		serveur = SPyTREP.Serveur(60, 'log.cfg', False, 'smoke', 1)
+		verifications = []
+		for nom, test, args in [('echange', echange, (serveur,)), ('roster', roster, (serveur,)),
+								('passation', passation, (workdir, options['port'])),
+								('brut', brut, (workdir, options['port'] + 1))]:
+			v = Verification(nom)
+			try:
+				test(v, *args)
+			except Exception as e:
+				v.erreurs.append("exception : %r" % e)
+			verifications.append(v)
+			print "%-10s : %s" % (nom, "ok" if not v.erreurs else "ECHEC")
+			for erreur in v.erreurs:
+				print "\t" + erreur
+		serveur.log_handler.close()
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(workdir, ignore_errors=True)
+	sys.exit(len([v for v in verifications if v.erreurs]))
+
+
+if __name__ == '__main__':
+	main()
@@ -32,29 +32,60 @@
 '''
 
 # Chargement des librairies dont twisted sert pour émuler un serveur web
-from twisted.web.server import Site
+from twisted.web.server import Site, NOT_DONE_YET
 from twisted.web.resource import Resource
+from twisted.web.http import CACHED, HTTPChannel, RESPONSES
 from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.error import CannotListenError, ReactorNotRunning
+from twisted.internet.interfaces import IFileDescriptorReceiver
+from twisted.internet.protocol import Factory, ClientFactory, ProcessProtocol, Protocol
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import NetstringReceiver
+from twisted.protocols.policies import TimeoutMixin
+from zope.interface import implementer
+from collections import deque, OrderedDict
+import bisect
+import cgi
+import cProfile
+import heapq
+import marshal
+import mmap
 import time
 import logging
 import logging.config
 import os
+import pstats
+import Queue
 import random
+import signal
+import socket
+import struct
 import sys
+import tempfile
+import threading
+import urllib
+from cStringIO import StringIO
+import urlparse
+import zlib
 
-class Player:
+class Player(object):
 	'''
 		Classe Player
 			Description :
 				Stock toute les infos sur le joueur dans une classe et non dans une
 				multitude de fichier comme le faisait le script php
+				
+				Les attributs sont dans des __slots__ (pas de __dict__ par joueur) et seul
+				le code (interné par Serveur.add_player) est gardé : l'ID et le nom en sont
+				extraits à la demande, ils ne servent qu'à l'affichage et à checkAuto
 
 			Liste des attributs :			
-				ID			: ID du Joueur
-				name		: Nom du Joueur
+				code		: Code du joueur (ID_Pseudo)
+				id			: ID du Joueur (calculé depuis code)
+				name		: Nom du Joueur (calculé depuis code)
 				last_seen	: Dernière présence enregister
-				pkm  		: Pokemon envoyé (version crypté)
-				friend		: ID du joueur avec qui on échange
+				friend		: Code du joueur avec qui on échange
 				ech			: Jeton/Timestamp pour l'échange 
 				ok			: Jeton/Timestamp pour la validation
 				ca			: Jeton/Timestamp pour l'annulation
@@ -63,57 +94,1309 @@ class Player:
 			Liste des méthodes :
 				__init__(Code)		: Créé un joueur depuis le Code (le code se présent sous la forme ID_Pseudo)
 				__repr__()			: Formatage de la classage joueur pour impression
-				seen()				: Actualise le la présence du joueur
-				set_ech()			: Actualise le Jeton/Timestamp pour l'échange
-				set_ok()			: Actualise le Jeton/Timestamp pour la validation
-				set_ca()			: Actualise le Jeton/Timestamp pour l'annulation
-				set_syn()			: Actualise le Jeton/Timestamp pour la syncronisation
+				seen(now)			: Actualise le la présence du joueur
+				set_ech(now)		: Actualise le Jeton/Timestamp pour l'échange
+				set_ok(now)			: Actualise le Jeton/Timestamp pour la validation
+				set_ca(now)			: Actualise le Jeton/Timestamp pour l'annulation
+				set_syn(now)		: Actualise le Jeton/Timestamp pour la syncronisation
+				
+				(now : date courante si l'appelant l'a déjà, sinon time.time())
 				reset_all()			: Remettre à 0 les Jeton/Timestamp
 	'''
 	
+	__slots__ = ('code', 'last_seen', 'friend', 'ech', 'ok', 'ca', 'syn')
+	
 	def __init__ (self,code):			
-		self.id, self.name = code.split("_",1)
+		self.code = code
 		self.last_seen = time.time()
-		self.pkm = ""
 		self.friend = ""
 		self.ech = 0
 		self.ok  = 0
 		self.ca  = 0
 		self.syn = 0
 	
+	@property
+	def id (self):
+		'''ID du Joueur'''
+		return self.code.split("_",1)[0]
+	
+	@property
+	def name (self):
+		'''Nom du Joueur'''
+		return self.code.split("_",1)[1]
+	
 	def __repr__(self):
 		'''Formatage de la classage joueur pour impression'''
 		return self.name + " (" + self.id + ")"
 		
-	def seen (self):
+	def seen (self,now=None):
 		'''Actualise la présence du joueur'''
-		self.last_seen = time.time()
+		self.last_seen = now or time.time()
 
-	def set_ech (self):
+	def set_ech (self,now=None):
 		'''Actualise le Jeton/Timestamp pour l'échange'''
-		self.ech = time.time()
+		self.ech = now or time.time()
 		
-	def set_ok (self):
+	def set_ok (self,now=None):
 		'''Actualise le Jeton/Timestamp pour la validation'''
-		self.ok = time.time()
+		self.ok = now or time.time()
 		
-	def set_ca (self):
+	def set_ca (self,now=None):
 		'''Actualise le Jeton/Timestamp pour l'annulation'''
-		self.ca = time.time()
+		self.ca = now or time.time()
 		
-	def set_syn (self):
+	def set_syn (self,now=None):
 		'''Actualise le Jeton/Timestamp pour la syncronisation'''
-		self.syn = time.time ()
+		self.syn = now or time.time ()
 	
 	def reset_all (self):
-		'''Remets à 0 les Jeton/Timestamp'''
-		self.pkm = ""		
+		'''Remets à 0 les Jeton/Timestamp (le pokemon est dans Serveur.pokemons)'''
 		self.friend = ""
 		self.ech = 0
 		self.ok = 0
 		self.ca = 0
 		self.syn = 0
 
+
+class Echange:
+	'''
+		Classe Echange
+			Description :
+				Echange entre deux joueurs avec un état explicite : chaque mode fait passer
+				l'échange d'un état à l'autre au lieu de recouper friend et les Jeton/Timestamp
+				des deux joueurs à chaque requette
+
+			Liste des attributs :
+				players		: Codes des deux joueurs (demandeur, demandé)
+				state		: Etat de l'échange (DEMANDE, ACCEPTE, ENVOYE, VALIDE, SYNCHRO ou ANNULE)
+				sent		: Codes des joueurs ayant envoyé leur pokemon
+				valid		: Codes des joueurs ayant validé
+				syn			: Codes des joueurs synchronisés
+				cancel		: Code du joueur qui a annulé (ou déconnecté)
+				since		: Date du dernier changement d'état
+
+			Liste des méthodes :
+				__init__(code_1,code_2,now)	: Créé la demande d'échange de code_1 à code_2
+				__repr__()					: Formatage de l'échange pour impression
+				partner(code)				: Renvoie le code du partenaire de code
+				set_state(state,now)		: Change l'état de l'échange (jamais en arrière)
+				active()					: Vrai si l'échange est accepté et pas annulé
+	'''
+	
+	DEMANDE, ACCEPTE, ENVOYE, VALIDE, SYNCHRO, ANNULE = range(6)
+	states = ['demande', 'accepte', 'envoye', 'valide', 'synchro', 'annule']
+	
+	def __init__ (self,code_1,code_2,now):
+		self.players = (code_1, code_2)
+		self.state = Echange.DEMANDE
+		self.sent = set()
+		self.valid = set()
+		self.syn = set()
+		self.cancel = None
+		self.since = now
+	
+	def __repr__ (self):
+		'''Formatage de l'échange pour impression'''
+		return "%s <-> %s (%s)" % (self.players[0], self.players[1], self.states[self.state])
+	
+	def partner (self,code):
+		'''Renvoie le code du partenaire de code'''
+		if code == self.players[0]:
+			return self.players[1]
+		return self.players[0]
+	
+	def set_state (self,state,now):
+		'''Change l'état de l'échange (un échange ne revient jamais en arrière)'''
+		if state > self.state:
+			self.state = state
+			self.since = now
+	
+	def active (self):
+		'''Vrai si l'échange est accepté et pas annulé'''
+		return Echange.ACCEPTE <= self.state < Echange.ANNULE
+
+
+class Attente:
+	'''
+		Classe Attente
+			Description :
+				Requette POST mise en attente (long-poll) jusqu'à ce que le partenaire
+				bouge ou que le temps de maintien soit écoulé
+
+			Liste des attributs :
+				request		: Requette twisted en attente (NOT_DONE_YET)
+				code		: Code du partenaire surveillé
+				etat		: Dernier état connu du partenaire (cf. Serveur.etat_partenaire)
+				call		: Appel différé qui libère la requette à la fin du maintien
+				start		: Date d'arrivée de la requette (pour la capture)
+	'''
+
+	def __init__ (self,request,code,etat,start=None):
+		self.request = request
+		self.code = code
+		self.etat = etat
+		self.call = None
+		self.start = start
+
+
+class BatchHandler(logging.Handler):
+	'''
+		Classe BatchHandler
+			Description :
+				Handler de log non bloquant : les messages sont mis dans une file bornée
+				et écrits par lots par un thread dédié dans les handlers d'origine (ceux de
+				log.cfg). Si la file est pleine le message est perdu et compté, le reactor
+				n'attend jamais après le disque.
+
+			Liste des attributs :
+				handlers	: Handlers réels (fichier, console...) alimentés par le thread
+				queue		: File bornée des messages en attente d'écriture
+				batch		: Nombre maximal de messages écrits par lot
+				dropped		: Nombre de messages perdus (file pleine)
+				reported	: Nombre de messages perdus déjà signalés dans le log
+				thread		: Thread d'écriture
+
+			Liste des méthodes :
+				emit(record)	: Mets le message dans la file (appelé par le logger)
+				run()			: Boucle du thread d'écriture
+				write(records)	: Ecrit un lot de messages dans les handlers réels
+				close()			: Vide la file et ferme les handlers réels
+
+			Liste des variables :
+				active			: BatchHandler en place dans le processus (un seul, cf. Serveur.init_batch)
+	'''
+
+	active = None
+
+	def __init__ (self,handlers,size=10000,batch=256):
+		logging.Handler.__init__(self)
+		self.handlers = handlers
+		self.queue = Queue.Queue(size)
+		self.batch = batch
+		self.dropped = 0
+		self.reported = 0
+		# Inutile de mettre en file ce qu'aucun handler n'écrira
+		self.setLevel(min([handler.level for handler in handlers] or [logging.NOTSET]))
+		self.thread = threading.Thread(target=self.run, name="BatchHandler")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def emit (self,record):
+		'''Mets le message dans la file (formaté ici car ses arguments peuvent changer ensuite)'''
+		try:
+			record.msg = record.getMessage()
+			record.args = None
+			if record.exc_info:
+				record.exc_text = logging.Formatter().formatException(record.exc_info)
+				record.exc_info = None
+			self.queue.put_nowait(record)
+		except Queue.Full:
+			self.dropped += 1
+		except Exception:
+			self.handleError(record)
+
+	def run (self):
+		'''Boucle du thread d'écriture : attend un message puis prend tout ce qui est arrivé entre temps'''
+		while True:
+			records = [self.queue.get()]
+			try:
+				while len(records) < self.batch:
+					records.append(self.queue.get_nowait())
+			except Queue.Empty:
+				pass
+			if self.dropped != self.reported:
+				lost = self.dropped - self.reported
+				self.reported += lost
+				records.append(logging.makeLogRecord({'msg': "%s messages de log perdus (file pleine)" % lost, 'levelno': logging.WARNING, 'levelname': 'WARNING'}))
+			stop = None in records
+			self.write([record for record in records if record is not None])
+			if stop:
+				return
+
+	def write (self,records):
+		'''Ecrit un lot de messages : une seule écriture (et un seul flush) par handler de type flux'''
+		for handler in self.handlers:
+			lot = [record for record in records if record.levelno >= handler.level and handler.filter(record)]
+			if not lot:
+				continue
+			try:
+				if isinstance(handler, logging.StreamHandler):
+					text = "".join([handler.format(record) + "\n" for record in lot])
+					handler.acquire()
+					try:
+						if handler.stream is None:
+							handler.stream = handler._open()
+						handler.stream.write(text)
+						handler.flush()
+					finally:
+						handler.release()
+				else:
+					for record in lot:
+						handler.handle(record)
+			except Exception:
+				self.handleError(lot[0])
+
+	def close (self):
+		'''Vide la file et ferme les handlers réels'''
+		if self.thread.is_alive():
+			self.queue.put(None)
+			self.thread.join(5)
+		for handler in self.handlers:
+			handler.close()
+		logging.Handler.close(self)
+
+
+class Journal:
+	'''
+		Classe Journal
+			Description :
+				Journal des échanges en binaire, en ajout seul : un enregistrement de taille
+				fixe par événement (demande, acceptation, envoi du pokemon, validation,
+				synchro, annulation, timeout). Comme pour BatchHandler le reactor ne fait
+				que mettre l'événement dans une file bornée, un thread écrit tout ce qui
+				est arrivé entre temps en une écriture et un seul fsync (group commit).
+				Lecture : cf. Journal.read et SPyJournal.py
+				
+				Fichier : entête (magic, version, taille d'un enregistrement) puis les
+				enregistrements (cf. record) :
+					date (double), événement, réservé, taille du pokemon,
+					id et nom du joueur, id et nom du partenaire, crc32 des champs précédents
+				Les noms sont tronqués à 16 octets, un id qui n'est pas un entier 64 bits vaut 0.
+				
+			Liste des attributs :
+				path		: Fichier du journal
+				queue		: File bornée des événements en attente d'écriture
+				batch		: Nombre max d'événements par écriture
+				dropped		: Nombre d'événements perdus (file pleine)
+				written		: Nombre d'événements écrits
+				thread		: Thread d'écriture
+				
+			Liste des méthodes :
+				add(event,code,partner,size)	: Mets un événement dans la file (reactor)
+				run()							: Boucle du thread d'écriture
+				close()							: Vide la file et ferme le fichier
+				read(path)						: Itère sur les enregistrements d'un journal (date, événement, ...)
+	'''
+	
+	DEMANDE, ACCEPTE, ENVOI, VALIDE, SYNCHRO, ANNULE, TIMEOUT = range(7)
+	events = ['demande', 'accepte', 'envoi', 'valide', 'synchro', 'annule', 'timeout']
+	header = struct.Struct('<4sHH')
+	record = struct.Struct('<dBBHQ16sQ16sI')
+	magic = 'SPYJ'
+	version = 1
+	
+	def __init__ (self,logger,path,size=100000,batch=4096):
+		self.logger = logger
+		self.path = path
+		self.queue = Queue.Queue(size)
+		self.batch = batch
+		self.dropped = 0
+		self.written = 0
+		self.file = open(path, 'ab')
+		if self.file.tell() == 0:
+			self.file.write(self.header.pack(self.magic, self.version, self.record.size))
+			self.file.flush()
+		else:
+			with open(path, 'rb') as f:
+				if f.read(self.header.size) != self.header.pack(self.magic, self.version, self.record.size):
+					raise ValueError("%s n'est pas un journal SPyTREP version %s" % (path, self.version))
+		self.thread = threading.Thread(target=self.run, name="Journal")
+		self.thread.daemon = True
+		self.thread.start()
+	
+	def add (self,event,code,partner,size=0,now=None):
+		'''Mets un événement dans la file (la mise en forme binaire se fait dans le thread)'''
+		try:
+			self.queue.put_nowait((now or time.time(), event, code, partner, size))
+		except Queue.Full:
+			self.dropped += 1
+	
+	@classmethod
+	def split (cls,code):
+		id, name = code.split("_", 1) if code else ("0", "")
+		id = int(id) if id.isdigit() and len(id) < 20 else 0
+		return (id if id < 1 << 64 else 0), name[:16]
+	
+	def pack (self,event):
+		now, kind, code, partner, size = event
+		fields = (now, kind, 0, min(size, 0xffff)) + self.split(code) + self.split(partner)
+		data = self.record.pack(*(fields + (0,)))
+		return data[:-4] + struct.pack('<I', zlib.crc32(data[:-4]) & 0xffffffff)
+	
+	def run (self):
+		'''Boucle du thread d'écriture : une écriture et un fsync pour tout ce qui est en file'''
+		while True:
+			events = [self.queue.get()]
+			try:
+				while len(events) < self.batch:
+					events.append(self.queue.get_nowait())
+			except Queue.Empty:
+				pass
+			stop = None in events
+			events = [event for event in events if event is not None]
+			try:
+				if events:
+					self.file.write("".join([self.pack(event) for event in events]))
+					self.file.flush()
+					os.fsync(self.file.fileno())
+					self.written += len(events)
+			except (IOError, OSError) as e:
+				self.logger.error("Ecriture du journal %s impossible : %s", self.path, e)
+			if stop:
+				return
+	
+	def close (self):
+		'''Vide la file et ferme le fichier'''
+		if self.thread.is_alive():
+			self.queue.put(None)
+			self.thread.join(5)
+		self.file.close()
+	
+	@classmethod
+	def read (cls,path,check=False,chunk=65536):
+		'''
+			Itère sur les enregistrements d'un journal :
+				(date, événement, taille, id, nom, id partenaire, nom partenaire)
+			La lecture se fait par blocs de chunk enregistrements, check vérifie les crc32
+			(un enregistrement corrompu lève ValueError, un enregistrement incomplet en fin
+			de fichier - arrêt pendant une écriture - est ignoré).
+		'''
+		record = cls.record
+		unpack = record.unpack_from
+		size = record.size
+		with open(path, 'rb') as f:
+			if f.read(cls.header.size) != cls.header.pack(cls.magic, cls.version, size):
+				raise ValueError("%s n'est pas un journal SPyTREP version %s" % (path, cls.version))
+			position = cls.header.size
+			while True:
+				data = f.read(size * chunk)
+				count = len(data) // size
+				for offset in xrange(0, count * size, size):
+					now, event, reserve, length, id, name, partner_id, partner_name, crc = unpack(data, offset)
+					if check and zlib.crc32(buffer(data, offset, size - 4)) & 0xffffffff != crc:
+						raise ValueError("Enregistrement corrompu a l'octet %s" % (position + offset))
+					yield (now, event, length, id, name.rstrip('\0'), partner_id, partner_name.rstrip('\0'))
+				if len(data) < size * chunk:
+					return
+				position += len(data)
+
+
+class Capture:
+	'''
+		Classe Capture
+			Description :
+				Enregistre le trafic réel (arguments, date, réponse) dans une trace compacte
+				pour le rejouer plus tard sur un serveur neuf (cf. SPyReplay.py). Même principe
+				que Journal : le reactor met l'enregistrement dans une file bornée, un thread
+				écrit le tout par paquets (sans fsync : une trace n'est pas un journal d'audit).
+				
+				Fichier : entête (magic, version) puis pour chaque requette un entier (taille)
+				et un tuple sérialisé avec marshal :
+					(date d'arrivée, méthode, arguments, ip, code HTTP, taille de la réponse,
+					 crc32 de la réponse, réponse ou None, mise en attente)
+				La réponse enregistrée est celle d'avant la compression, elle n'est gardée
+				en entier que si elle fait moins de body_max octets (le crc32 suffit pour
+				comparer, le corps sert à montrer les différences).
+				Les requettes d'administration (admin, metrics, profil) ne sont pas capturées :
+				elles portent le masterCode.
+				
+			Liste des attributs :
+				path		: Fichier de la trace
+				queue		: File bornée des requettes en attente d'écriture
+				body_max	: Taille max d'une réponse gardée en entier
+				dropped		: Nombre de requettes perdues (file pleine)
+				written		: Nombre de requettes écrites
+				thread		: Thread d'écriture
+				
+			Liste des méthodes :
+				add(request,code,body,start,parked)	: Mets une requette et sa réponse dans la file (reactor)
+				run()								: Boucle du thread d'écriture
+				close()								: Vide la file et ferme le fichier
+				read(path)							: Itère sur les requettes d'une trace
+	'''
+	
+	header = struct.Struct('<4sH')
+	size = struct.Struct('<I')
+	magic = 'SPYC'
+	version = 1
+	
+	def __init__ (self,logger,path,size=100000,batch=4096,body_max=1024):
+		self.logger = logger
+		self.path = path
+		self.queue = Queue.Queue(size)
+		self.batch = batch
+		self.body_max = body_max
+		self.dropped = 0
+		self.written = 0
+		self.file = open(path, 'ab')
+		if self.file.tell() == 0:
+			self.file.write(self.header.pack(self.magic, self.version))
+			self.file.flush()
+		else:
+			with open(path, 'rb') as f:
+				if f.read(self.header.size) != self.header.pack(self.magic, self.version):
+					raise ValueError("%s n'est pas une trace SPyTREP version %s" % (path, self.version))
+		self.thread = threading.Thread(target=self.run, name="Capture")
+		self.thread.daemon = True
+		self.thread.start()
+	
+	def add (self,request,code,body,start=None,parked=False):
+		'''Mets une requette et sa réponse dans la file (la sérialisation se fait dans le thread)'''
+		try:
+			self.queue.put_nowait((start or time.time(), request.method, request.args, request.getClientIP(), code, body, parked))
+		except Queue.Full:
+			self.dropped += 1
+	
+	def pack (self,record):
+		now, method, args, ip, code, body, parked = record
+		data = marshal.dumps((now, method, args, ip, code, len(body), zlib.crc32(body) & 0xffffffff,
+			body if len(body) <= self.body_max else None, parked))
+		return self.size.pack(len(data)) + data
+	
+	def run (self):
+		'''Boucle du thread d'écriture : une écriture pour tout ce qui est en file'''
+		while True:
+			records = [self.queue.get()]
+			try:
+				while len(records) < self.batch:
+					records.append(self.queue.get_nowait())
+			except Queue.Empty:
+				pass
+			stop = None in records
+			records = [record for record in records if record is not None]
+			try:
+				if records:
+					self.file.write("".join([self.pack(record) for record in records]))
+					self.file.flush()
+					self.written += len(records)
+			except (IOError, OSError, ValueError) as e:
+				self.logger.error("Ecriture de la capture %s impossible : %s", self.path, e)
+			if stop:
+				return
+	
+	def close (self):
+		'''Vide la file et ferme le fichier'''
+		if self.thread.is_alive():
+			self.queue.put(None)
+			self.thread.join(5)
+		self.file.close()
+	
+	@classmethod
+	def read (cls,path):
+		'''
+			Itère sur les requettes d'une trace :
+				(date, méthode, arguments, ip, code, taille, crc32, réponse ou None, mise en attente)
+			Une requette incomplète en fin de fichier (arrêt pendant une écriture) est ignorée.
+		'''
+		with open(path, 'rb') as f:
+			if f.read(cls.header.size) != cls.header.pack(cls.magic, cls.version):
+				raise ValueError("%s n'est pas une trace SPyTREP version %s" % (path, cls.version))
+			while True:
+				size = f.read(cls.size.size)
+				if len(size) < cls.size.size:
+					return
+				data = f.read(cls.size.unpack(size)[0])
+				try:
+					yield marshal.loads(data)
+				except (EOFError, ValueError, TypeError):
+					return
+
+
+class Echantillon(logging.Filter):
+	'''
+		Classe Echantillon
+			Description :
+				Filtre de log qui ne garde qu'un message sur N pour les messages fréquents
+				("attend", "regarde") de chaque mode. Seuls les messages portant un attribut
+				'mode' (passé par extra={'mode': ...}) sont concernés.
+
+			Liste des attributs :
+				rates		: Dico des taux d'échantillonnage (clefs = mode, valeurs = N)
+				counts		: Dico des compteurs de messages (clefs = mode)
+	'''
+
+	def __init__ (self,rates):
+		logging.Filter.__init__(self)
+		self.rates = rates
+		self.counts = dict.fromkeys(rates, 0)
+
+	def filter (self,record):
+		mode = getattr(record, 'mode', None)
+		if mode not in self.rates:
+			return True
+		self.counts[mode] += 1
+		return self.counts[mode] % self.rates[mode] == 1 % self.rates[mode]
+
+
+class Metriques:
+	'''
+		Classe Metriques
+			Description :
+				Compteurs et histogrammes de latence par mode POST, exportés au format
+				texte de Prometheus. Une observation coûte une recherche dichotomique et
+				deux additions, rien n'est calculé avant l'export.
+
+			Liste des attributs :
+				buckets		: Bornes supérieures (secondes) des classes de l'histogramme
+				counts		: Dico des histogrammes (clefs = mode, valeurs = liste de compteurs par classe)
+				sums		: Dico des sommes des latences par mode
+				errors		: Dico du nombre de requettes refusées (réponse "Requette ... invalide") par mode
+				timeouts	: Nombre de joueurs sortis par timeout
+
+			Liste des méthodes :
+				observe(mode,duration,error)	: Enregistre une requette
+				render(gauges)					: Renvoie l'export texte (avec les jauges données)
+	'''
+
+	buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+	def __init__ (self):
+		self.counts = {}
+		self.sums = {}
+		self.errors = {}
+		self.timeouts = 0
+
+	def observe (self,mode,duration,error=False):
+		'''Enregistre une requette de type mode qui a pris duration secondes'''
+		counts = self.counts.get(mode)
+		if counts is None:
+			counts = self.counts[mode] = [0] * (len(self.buckets) + 1)
+			self.sums[mode] = 0.0
+			self.errors[mode] = 0
+		counts[bisect.bisect_left(self.buckets, duration)] += 1
+		self.sums[mode] += duration
+		if error:
+			self.errors[mode] += 1
+
+	def render (self,gauges):
+		'''Export au format texte de Prometheus (gauges = liste de tuples (nom, aide, valeur))'''
+		text = ["# HELP spytrep_requests_total Requettes POST recues par mode\n",
+				"# TYPE spytrep_requests_total counter\n"]
+		text.extend(['spytrep_requests_total{mode="%s"} %d\n' % (mode, sum(counts)) for mode, counts in sorted(self.counts.items())])
+		text.append("# HELP spytrep_request_errors_total Requettes POST refusees par mode\n")
+		text.append("# TYPE spytrep_request_errors_total counter\n")
+		text.extend(['spytrep_request_errors_total{mode="%s"} %d\n' % (mode, errors) for mode, errors in sorted(self.errors.items())])
+		text.append("# HELP spytrep_request_duration_seconds Temps de traitement des requettes POST par mode\n")
+		text.append("# TYPE spytrep_request_duration_seconds histogram\n")
+		for mode, counts in sorted(self.counts.items()):
+			total = 0
+			for bound, count in zip(self.buckets, counts):
+				total += count
+				text.append('spytrep_request_duration_seconds_bucket{mode="%s",le="%s"} %d\n' % (mode, bound, total))
+			total += counts[-1]
+			text.append('spytrep_request_duration_seconds_bucket{mode="%s",le="+Inf"} %d\n' % (mode, total))
+			text.append('spytrep_request_duration_seconds_sum{mode="%s"} %f\n' % (mode, self.sums[mode]))
+			text.append('spytrep_request_duration_seconds_count{mode="%s"} %d\n' % (mode, total))
+		text.append("# HELP spytrep_timeouts_total Joueurs sortis par timeout\n")
+		text.append("# TYPE spytrep_timeouts_total counter\n")
+		text.append("spytrep_timeouts_total %d\n" % self.timeouts)
+		for name, help, value in gauges:
+			text.append("# HELP %s %s\n# TYPE %s gauge\n%s %s\n" % (name, help, name, name, value))
+		return "".join(text)
+
+
+class Limiteur:
+	'''
+		Classe Limiteur
+			Description :
+				Anti-spam : un seau à jetons par IP et un par code joueur (monCode), vérifié
+				en O(1) avant tout traitement de la requette. Une clef qui dépasse trop souvent
+				sa limite (ou qui envoie trop de requettes mal formées) est bannie un moment.
+
+			Liste des attributs :
+				limits		: Dico des limites (clefs = 'ip' ou 'code', valeurs = (jetons/s, jetons max)), 0 = pas de limite
+				buckets		: Dico des seaux (clefs = (type, valeur), valeurs = [jetons, date du dernier remplissage])
+				strikes		: Dico des infractions depuis la dernière purge (clefs = (type, valeur))
+				bans		: Dico des bannissements (clefs = (type, valeur), valeurs = date de fin)
+				ban_after	: Nombre d'infractions avant bannissement (0 = jamais)
+				ban_time	: Durée d'un bannissement en secondes
+
+			Liste des méthodes :
+				check(ip,code,now)		: None si la requette passe, sinon (code HTTP, secondes avant de réessayer)
+				offense(key,now)		: Compte une infraction (et bannit au besoin)
+				purge(now)				: Oublie les seaux pleins, les bannissements finis et les infractions
+	'''
+
+	def __init__ (self,logger,rate=0,burst=20,rate_ip=0,burst_ip=100,ban_after=0,ban_time=300):
+		self.logger = logger
+		self.limits = {'code': (rate, burst), 'ip': (rate_ip, burst_ip)}
+		self.buckets = {}
+		self.strikes = {}
+		self.bans = {}
+		self.ban_after = ban_after
+		self.ban_time = ban_time
+
+	def allow (self,key,now):
+		'''Prend un jeton dans le seau de key (False s'il est vide)'''
+		rate, burst = self.limits[key[0]]
+		if not rate:
+			return True
+		bucket = self.buckets.get(key)
+		if bucket is None:
+			bucket = self.buckets[key] = [burst, now]
+		else:
+			bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+			bucket[1] = now
+		if bucket[0] >= 1:
+			bucket[0] -= 1
+			return True
+		return False
+
+	def check (self,ip,code,now):
+		'''None si la requette passe, sinon (code HTTP, secondes avant de réessayer)'''
+		keys = [('ip', ip)]
+		if code is not None:
+			keys.append(('code', code))
+		if self.bans:
+			for key in keys:
+				until = self.bans.get(key)
+				if until is not None and until > now:
+					return (403, int(until - now) + 1)
+		for key in keys:
+			if not self.allow(key, now):
+				if self.offense(key, now):
+					return (403, self.ban_time)
+				return (429, 1)
+		return None
+
+	def offense (self,key,now):
+		'''Compte une infraction pour key, renvoie True si key vient d'être bannie'''
+		if not self.ban_after:
+			return False
+		strikes = self.strikes.get(key, 0) + 1
+		if strikes < self.ban_after:
+			self.strikes[key] = strikes
+			return False
+		self.strikes.pop(key, None)
+		self.bans[key] = now + self.ban_time
+		self.logger.warning("Bannissement de %s %s pour %s secondes", key[0], key[1], self.ban_time)
+		return True
+
+	def purge (self,now=None):
+		'''Oublie les seaux redevenus pleins, les bannissements terminés et les infractions'''
+		now = now or time.time()
+		for key, bucket in self.buckets.items():
+			rate, burst = self.limits[key[0]]
+			if not rate or bucket[0] + (now - bucket[1]) * rate >= burst:
+				del self.buckets[key]
+		for key, until in self.bans.items():
+			if until <= now:
+				del self.bans[key]
+		self.strikes = {}
+
+
+class Admission:
+	'''
+		Classe Admission
+			Description :
+				Contrôle d'admission : un nombre max de joueurs connectés et un chien de garde
+				qui mesure le retard du reactor (écart entre la date prévue d'un appel périodique
+				et sa date réelle, c'est le temps que passent les requettes dans la file). Quand
+				le serveur est plein ou en retard, les nouveaux joueurs reçoivent tout de suite
+				un 503 + Retry-After au lieu de ralentir tout le monde (cf. Serveur.admit).
+				Le Retry-After est tiré entre retry_after et 2 * retry_after pour étaler les
+				reconnexions.
+
+			Liste des attributs :
+				max_players	: Nombre max de joueurs connectés (0 = pas de limite)
+				max_lag		: Retard du reactor (secondes) au delà duquel on est en surcharge (0 = pas de chien de garde)
+				retry_after	: Délai minimal avant de réessayer conseillé au client (secondes)
+				interval	: Période du chien de garde (secondes)
+				lag			: Retard moyen du reactor (moyenne glissante, secondes)
+				overloaded	: Vrai pendant une surcharge (jusqu'à ce que lag repasse sous max_lag / 2)
+				refused		: Nombre de requettes refusées
+				watchdog	: Tâche périodique du chien de garde
+
+			Liste des méthodes :
+				tick()				: Mesure le retard du reactor (appelée par watchdog)
+				check(players)		: None si un nouveau joueur peut entrer, sinon secondes avant de réessayer
+	'''
+
+	def __init__ (self,logger,max_players=0,max_lag=0,retry_after=5,interval=0.1):
+		self.logger = logger
+		self.max_players = max_players
+		self.max_lag = max_lag
+		self.retry_after = retry_after
+		self.interval = interval
+		self.lag = 0.0
+		self.overloaded = False
+		self.refused = 0
+		self.last = None
+		self.watchdog = None
+		if max_lag:
+			self.watchdog = LoopingCall(self.tick)
+			self.watchdog.start(interval)
+
+	def tick (self):
+		'''Mesure le retard du reactor et passe en surcharge (ou en sort) au besoin'''
+		now = time.time()
+		if self.last is not None:
+			self.lag = 0.8 * self.lag + 0.2 * max(0.0, now - self.last - self.interval)
+			if not self.overloaded and self.lag > self.max_lag:
+				self.overloaded = True
+				self.logger.warning("Surcharge : retard du reactor de %d ms, nouveaux joueurs refuses", self.lag * 1000)
+			elif self.overloaded and self.lag < self.max_lag / 2:
+				self.overloaded = False
+				self.logger.warning("Fin de la surcharge : retard du reactor de %d ms", self.lag * 1000)
+		self.last = now
+
+	def check (self,players):
+		'''None si un nouveau joueur peut entrer, sinon secondes avant de réessayer'''
+		if not self.overloaded and not (self.max_players and players >= self.max_players):
+			return None
+		self.refused += 1
+		return random.randint(self.retry_after, 2 * self.retry_after)
+
+
+class Reserve:
+	'''
+		Classe Reserve
+			Description :
+				Pokemons envoyés (mode sent) en attente d'être lus par le partenaire.
+				Les données sont gardées telles que reçues (pas de copie), avec une taille
+				max par pokemon (optionnelle) et une taille max totale en mémoire. Une fois la
+				mémoire pleine les pokemons les moins lus partent dans un fichier mappé en
+				mémoire, découpés en cases de slot_size octets (pas forcément contiguës, il n'y
+				a donc pas de fragmentation), s'il n'y a pas de fichier ou qu'il est plein le
+				pokemon est refusé. Un pokemon refusé ne remplace pas celui déjà rangé pour le
+				même joueur.
+				
+			Liste des attributs :
+				max_size	: Taille max d'un pokemon en octets (0 = pas de limite)
+				max_total	: Taille max de l'ensemble des pokemons en mémoire
+				slot_size	: Taille d'une case du fichier
+				mem			: OrderedDict des pokemons en mémoire, du moins au plus récemment lu (clefs = code joueur)
+				total		: Taille des pokemons en mémoire
+				spilled		: Dico des pokemons déportés (clefs = code joueur, valeurs = (liste des cases, taille))
+				free_slots	: Cases libres du fichier
+				map			: Fichier mappé (None = pas de déport)
+				refused		: Nombre de pokemons refusés
+				
+			Liste des méthodes :
+				put(code,data)	: Range le pokemon de code (False s'il est refusé)
+				get(code)		: Renvoie le pokemon de code ("" s'il n'y en a pas), il devient le plus récemment lu
+				peek(code)		: Comme get sans toucher à l'ordre de lecture (sauvegarde)
+				read(code)		: Relit un pokemon déporté dans le fichier
+				free(code)		: Libère le pokemon de code
+				spill(size)		: Déporte les pokemons les moins lus jusqu'à libérer size octets (False si le fichier est plein)
+	'''
+
+	def __init__ (self,logger,max_size=0,max_total=32 << 20,spill=None,slots=16384,slot_size=2048):
+		self.logger = logger
+		self.max_size = max_size
+		self.max_total = max_total
+		self.slot_size = slot_size
+		self.mem = OrderedDict()
+		self.total = 0
+		self.spilled = {}
+		self.refused = 0
+		self.map = None
+		self.free_slots = []
+		if spill:
+			with open(spill, 'w+b') as f:
+				f.truncate(slots * self.slot_size)
+				self.map = mmap.mmap(f.fileno(), slots * self.slot_size)
+			self.free_slots = range(slots - 1, -1, -1)
+
+	def __contains__ (self,code):
+		return code in self.mem or code in self.spilled
+
+	def __len__ (self):
+		return len(self.mem) + len(self.spilled)
+
+	def put (self,code,data):
+		size = len(data)
+		if self.max_size and size > self.max_size:
+			self.refused += 1
+			self.logger.warning("Pokemon de %s refuse : %s octets (max %s)", code, size, self.max_size)
+			return False
+		# L'ancien pokemon du joueur ne compte plus, mais il est gardé si le nouveau est refusé
+		old = self.mem.pop(code, None)
+		if old is not None:
+			self.total -= len(old)
+		if self.total + size > self.max_total and not self.spill(self.total + size - self.max_total):
+			if old is not None:
+				self.mem[code] = old
+				self.total += len(old)
+			self.refused += 1
+			self.logger.warning("Pokemon de %s refuse : reserve pleine", code)
+			return False
+		self.free(code)
+		self.mem[code] = data
+		self.total += size
+		return True
+
+	def get (self,code):
+		data = self.mem.pop(code, None)
+		if data is not None:
+			# Remis en fin de file : c'est le plus récemment lu
+			self.mem[code] = data
+			return data
+		return self.read(code)
+
+	def peek (self,code):
+		data = self.mem.get(code)
+		if data is not None:
+			return data
+		return self.read(code)
+
+	def read (self,code):
+		'''Relit un pokemon déporté (case par case)'''
+		spilled = self.spilled.get(code)
+		if spilled is None:
+			return ""
+		slots, size = spilled
+		pieces = []
+		for slot in slots:
+			offset = slot * self.slot_size
+			pieces.append(self.map[offset:offset + min(size, self.slot_size)])
+			size -= self.slot_size
+		return "".join(pieces)
+
+	def free (self,code):
+		data = self.mem.pop(code, None)
+		if data is not None:
+			self.total -= len(data)
+			return
+		spilled = self.spilled.pop(code, None)
+		if spilled is not None:
+			self.free_slots.extend(spilled[0])
+
+	def spill (self,size):
+		'''
+			Déporte les pokemons les moins récemment lus (tête de mem) dans le fichier,
+			False si le fichier est plein avant d'avoir libéré size octets (ce qui a été
+			déporté le reste, ce sont des pokemons valides)
+		'''
+		if self.map is None:
+			return False
+		while size > 0 and self.mem:
+			code = next(iter(self.mem))
+			data = self.mem[code]
+			count = -(-len(data) // self.slot_size) or 1
+			if count > len(self.free_slots):
+				return False
+			del self.mem[code]
+			slots = [self.free_slots.pop() for i in xrange(count)]
+			for i, slot in enumerate(slots):
+				offset = slot * self.slot_size
+				piece = data[i * self.slot_size:(i + 1) * self.slot_size]
+				self.map[offset:offset + len(piece)] = piece
+			self.spilled[code] = (slots, len(data))
+			self.total -= len(data)
+			size -= len(data)
+		return size <= 0
+
+
+class Compresseur:
+	'''
+		Classe Compresseur
+			Description :
+				Compression des réponses (gzip ou deflate, selon Accept-Encoding) au delà
+				d'une taille minimale. Les corps compressés des réponses qui reviennent à
+				l'identique d'un poll à l'autre (liste des joueurs, pokemon, page publique)
+				sont gardés dans un cache LRU borné en octets : la clef est le corps lui même,
+				dont Python garde le hash, une même chaîne n'est donc compressée qu'une fois.
+				
+			Liste des attributs :
+				threshold	: Taille minimale d'une réponse compressée (0 = pas de compression)
+				level		: Niveau de compression zlib
+				cache		: OrderedDict des corps compressés (clefs = (encodage, corps))
+				max_bytes	: Taille max du cache (corps + corps compressés)
+				size		: Taille actuelle du cache
+				hits		: Nombre de réponses servies depuis le cache
+				saved		: Nombre d'octets économisés
+				
+			Liste des méthodes :
+				choose(request,body)				: encodage à utiliser (None = pas de compression)
+				encode(request,body,encoding,cache)	: renvoie le corps compressé et place les entêtes
+	'''
+	
+	encodings = ('gzip', 'deflate')
+	
+	def __init__ (self,threshold=256,level=6,max_bytes=8 << 20):
+		self.threshold = threshold
+		self.level = level
+		self.max_bytes = max_bytes
+		self.cache = OrderedDict()
+		self.size = 0
+		self.hits = 0
+		self.saved = 0
+	
+	def choose (self,request,body):
+		'''Encodage préféré du client (gzip puis deflate, en respectant q=0)'''
+		if not self.threshold or len(body) < self.threshold:
+			return None
+		request.setHeader('Vary', 'Accept-Encoding')
+		accept = request.getHeader('accept-encoding')
+		if not accept:
+			return None
+		accepted = {}
+		for part in accept.lower().split(','):
+			fields = part.strip().split(';')
+			q = 1.0
+			for field in fields[1:]:
+				field = field.strip()
+				if field.startswith('q='):
+					try:
+						q = float(field[2:])
+					except ValueError:
+						q = 0.0
+			accepted[fields[0].strip()] = q
+		for encoding in self.encodings:
+			if accepted.get(encoding, accepted.get('*', 0)) > 0:
+				return encoding
+		return None
+	
+	def encode (self,request,body,encoding,cache=True):
+		if encoding is None:
+			return body
+		key = (encoding, body)
+		data = self.cache.pop(key, None) if cache else None
+		if data is not None:
+			self.hits += 1
+		else:
+			if encoding == 'gzip':
+				compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+				data = compressor.compress(body) + compressor.flush()
+			else:
+				data = zlib.compress(body, self.level)
+			if cache:
+				self.size += len(body) + len(data)
+				while self.cache and self.size > self.max_bytes:
+					(old_encoding, old_body), old_data = self.cache.popitem(last=False)
+					self.size -= len(old_body) + len(old_data)
+		if cache:
+			self.cache[key] = data
+		if len(data) >= len(body):
+			return body
+		self.saved += len(body) - len(data)
+		request.setHeader('Content-Encoding', encoding)
+		return data
+
+
+class Triee:
+	'''
+		Classe Triee
+			Description :
+				Liste triée découpée en seaux d'au plus 2*load clefs, avec accès par position :
+				un ajout ou un retrait coûte O(log N + load) (bisect sur les maximums des seaux
+				puis insort dans un seau), une position O(log N) une fois les décalages des
+				seaux recalculés (O(N / load), seulement après une modification).
+				
+			Liste des attributs :
+				buckets	: Seaux (listes triées, le premier contient les plus petites clefs)
+				maxes	: Plus grande clef de chaque seau
+				offsets	: Position de la première clef de chaque seau (None = à recalculer)
+				size	: Nombre total de clefs
+				
+			Liste des méthodes :
+				add(key)				: ajoute une clef
+				remove(key)				: retire une clef (False si absente)
+				bisect_left(key)		: position où key serait insérée
+				slice(start,stop)		: clefs des positions start à stop (exclue)
+				
+			Liste des variables :
+				load	: Taille de référence des seaux
+	'''
+	
+	load = 512
+	
+	def __init__ (self):
+		self.buckets = []
+		self.maxes = []
+		self.offsets = None
+		self.size = 0
+	
+	def __len__ (self):
+		return self.size
+	
+	def add (self,key):
+		self.offsets = None
+		self.size += 1
+		if not self.buckets:
+			self.buckets.append([key])
+			self.maxes.append(key)
+			return
+		i = min(bisect.bisect_left(self.maxes, key), len(self.maxes) - 1)
+		bucket = self.buckets[i]
+		bisect.insort(bucket, key)
+		if len(bucket) > 2 * self.load:
+			self.buckets[i:i+1] = [bucket[:self.load], bucket[self.load:]]
+			self.maxes[i:i+1] = [bucket[self.load - 1], bucket[-1]]
+		else:
+			self.maxes[i] = bucket[-1]
+	
+	def remove (self,key):
+		i = bisect.bisect_left(self.maxes, key)
+		if i == len(self.maxes):
+			return False
+		bucket = self.buckets[i]
+		j = bisect.bisect_left(bucket, key)
+		if j == len(bucket) or bucket[j] != key:
+			return False
+		del bucket[j]
+		self.offsets = None
+		self.size -= 1
+		if bucket:
+			self.maxes[i] = bucket[-1]
+		else:
+			del self.buckets[i]
+			del self.maxes[i]
+		return True
+	
+	def locate (self):
+		if self.offsets is None:
+			self.offsets = []
+			total = 0
+			for bucket in self.buckets:
+				self.offsets.append(total)
+				total += len(bucket)
+		return self.offsets
+	
+	def bisect_left (self,key):
+		i = bisect.bisect_left(self.maxes, key)
+		if i == len(self.maxes):
+			return self.size
+		return self.locate()[i] + bisect.bisect_left(self.buckets[i], key)
+	
+	def slice (self,start,stop):
+		stop = min(stop, self.size)
+		if start >= stop:
+			return []
+		offsets = self.locate()
+		i = bisect.bisect_right(offsets, start) - 1
+		keys = []
+		pos = start - offsets[i]
+		while len(keys) < stop - start:
+			keys.extend(self.buckets[i][pos:pos + stop - start - len(keys)])
+			i += 1
+			pos = 0
+		return keys
+
+
+class Index:
+	'''
+		Classe Index
+			Description :
+				Index des joueurs pour la page admin, tenus à jour à chaque connexion,
+				déconnexion et requette : par id, par nom (recherche par préfixe avec bisect)
+				et par date de dernière requette (numéro de passage décroissant), chacun dans
+				une Triee. Une mise à jour coûte O(log N + Triee.load), une page
+				O(taille de la page + log N) hors recalcul des décalages après modification.
+				
+			Liste des attributs :
+				ids		: Triee des (id numérique, code) pour le tri par id
+				id_text	: Triee des (id en texte, code) pour la recherche par préfixe d'id
+				names	: Triee des (nom en minuscules, code)
+				recent	: Triee des (-numéro de passage, code), le plus récemment vu d'abord
+				seen	: Dernier numéro de passage de chaque code
+				counter	: Numéro du dernier passage
+				
+			Liste des méthodes :
+				add(code)						: ajoute un joueur (le plus récemment vu)
+				remove(code)					: retire un joueur
+				touch(code)						: le joueur vient d'être vu
+				page(tri,prefix,start,size)		: codes de la page demandée et nombre total de résultats
+	'''
+	
+	def __init__ (self):
+		self.ids = Triee()
+		self.id_text = Triee()
+		self.names = Triee()
+		self.recent = Triee()
+		self.seen = {}
+		self.counter = 0
+	
+	def keys (self,code):
+		id, name = code.split("_",1)
+		return (int(id) if id.isdigit() else -1, code), (id, code), (name.lower(), code)
+	
+	def add (self,code):
+		for entries, key in zip((self.ids, self.id_text, self.names), self.keys(code)):
+			entries.add(key)
+		self.touch(code, True)
+	
+	def remove (self,code):
+		for entries, key in zip((self.ids, self.id_text, self.names), self.keys(code)):
+			entries.remove(key)
+		if code in self.seen:
+			self.recent.remove((-self.seen.pop(code), code))
+	
+	def touch (self,code,new=False):
+		if code in self.seen:
+			self.recent.remove((-self.seen[code], code))
+		elif not new:
+			return
+		self.counter += 1
+		self.seen[code] = self.counter
+		self.recent.add((-self.counter, code))
+	
+	def page (self,tri,prefix,start,size):
+		'''
+			tri = 'seen' : les plus récemment vus d'abord (sans recherche, sinon tri par nom)
+			tri = 'id' ou 'nom' : ordre croissant, prefix filtre sur l'id ou le nom
+			(avec un préfixe d'id l'ordre est celui du texte : 1, 10, 100, 11...)
+		'''
+		if tri == 'seen' and not prefix:
+			return [code for key, code in self.recent.slice(start, start + size)], len(self.recent)
+		if tri == 'id' and not prefix:
+			return [code for key, code in self.ids.slice(start, start + size)], len(self.ids)
+		if tri == 'id':
+			entries = self.id_text
+		else:
+			entries, prefix = self.names, prefix.lower()
+		lo = entries.bisect_left((prefix,))
+		hi = entries.bisect_left((prefix + '\xff',)) if prefix else len(entries)
+		return [code for key, code in entries.slice(lo + start, min(hi, lo + start + size))], hi - lo
+
+
+class Profileur:
+	'''
+		Classe Profileur
+			Description :
+				Profilage à la demande des requettes POST (page mode=profil, protégée par le
+				masterCode), agrégé par mode, pendant une durée limitée et pour une requette
+				sur N. Deux types :
+					cprofile	: cProfile sur Serveur.execute (temps exact, coût élevé)
+					pile		: échantillonnage de la pile sur SIGPROF (faible coût),
+								  export en piles repliées pour flamegraph.pl / speedscope
+				Profilage arrêté, rien ne reste en place : Serveur.execute n'est remplacé
+				(attribut d'instance) que pendant la fenêtre, le coût est nul le reste du temps.
+				
+			Liste des attributs :
+				serveur		: Serveur profilé
+				active		: Vrai pendant la fenêtre de profilage
+				kind		: Type de profilage (cprofile ou pile)
+				every		: Une requette profilée sur every
+				count		: Nombre de requettes vues pendant la fenêtre
+				profiles	: Dico des cProfile.Profile (clefs = mode)
+				stacks		: Dico des piles échantillonnées (clefs = mode, valeurs = {pile: nombre})
+				current		: Mode de la requette en cours de profilage (pile)
+				call		: Fin programmée de la fenêtre
+				
+			Liste des méthodes :
+				start(kind,every,duree,interval)	: ouvre une fenêtre de profilage (remet à zéro les résultats)
+				stop()								: ferme la fenêtre (les résultats restent disponibles)
+				execute(request,ip)					: remplace Serveur.execute pendant la fenêtre
+				sample(signum,frame)				: relève la pile (handler de SIGPROF)
+				render(request)						: page mode=profil (commande et téléchargement des résultats)
+	'''
+	
+	max_duree = 3600
+	
+	def __init__ (self,serveur):
+		self.serveur = serveur
+		self.active = False
+		self.kind = 'cprofile'
+		self.every = 1
+		self.count = 0
+		self.profiles = {}
+		self.stacks = {}
+		self.current = None
+		self.call = None
+	
+	def start (self,kind='cprofile',every=1,duree=60,interval=0.001):
+		self.stop()
+		self.kind = kind
+		self.every = max(every, 1)
+		self.count = 0
+		self.profiles = {}
+		self.stacks = {}
+		self.run = self.serveur.execute
+		self.serveur.execute = self.execute
+		if kind == 'pile':
+			signal.signal(signal.SIGPROF, self.sample)
+			# Les appels système interrompus (threads d'écriture) reprennent d'eux même
+			signal.siginterrupt(signal.SIGPROF, False)
+			signal.setitimer(signal.ITIMER_PROF, interval, interval)
+		self.active = True
+		self.call = reactor.callLater(min(duree, self.max_duree), self.stop)
+		self.serveur.logger.warning("Profilage %s d'une requette sur %s pendant %s secondes", kind, every, duree)
+	
+	def stop (self):
+		if not self.active:
+			return
+		self.active = False
+		del self.serveur.execute
+		if self.kind == 'pile':
+			signal.setitimer(signal.ITIMER_PROF, 0)
+			# Pas SIG_DFL : un SIGPROF déjà en route tuerait le processus
+			signal.signal(signal.SIGPROF, signal.SIG_IGN)
+		if self.call.active():
+			self.call.cancel()
+		self.serveur.logger.warning("Fin du profilage (%s requettes vues)", self.count)
+	
+	def execute (self,request,ip):
+		self.count += 1
+		if self.count % self.every:
+			return self.run(request, ip)
+		mode = request.args.get('mode', [None])[0]
+		if mode not in self.serveur.allows_modes:
+			mode = 'invalid'
+		if self.kind == 'cprofile':
+			profile = self.profiles.get(mode)
+			if profile is None:
+				profile = self.profiles[mode] = cProfile.Profile()
+			return profile.runcall(self.run, request, ip)
+		self.current = mode
+		try:
+			return self.run(request, ip)
+		finally:
+			self.current = None
+	
+	def sample (self,signum,frame):
+		'''Relève la pile depuis execute (rien si aucune requette profilée n'est en cours)'''
+		if self.current is None:
+			return
+		stack = []
+		top = Profileur.execute.__func__.__code__
+		while frame is not None and frame.f_code is not top:
+			stack.append("%s:%s" % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+			frame = frame.f_back
+		stack.append(self.current)
+		stack = ";".join(reversed(stack))
+		stacks = self.stacks.setdefault(self.current, {})
+		stacks[stack] = stacks.get(stack, 0) + 1
+	
+	def render (self,request):
+		'''
+			action=start [type=cprofile|pile] [un_sur=N] [duree=S]	: lance le profilage
+			action=stop												: l'arrête
+			action=texte [poste=mode]								: résumé pstats (temps cumulé)
+			action=pstats [poste=mode]								: fichier pstats (pour pstats/snakeviz)
+			action=pile [poste=mode]								: piles repliées (une ligne "pile nombre")
+			poste absent : tous les modes ensemble
+		'''
+		args = request.args
+		action = args.get('action', ['etat'])[0]
+		poste = args.get('poste', [None])[0]
+		request.setHeader('Content-Type', 'text/plain')
+		if action == 'start':
+			kind = args.get('type', ['cprofile'])[0]
+			every = args.get('un_sur', ['1'])[0]
+			duree = args.get('duree', ['60'])[0]
+			self.start('pile' if kind == 'pile' else 'cprofile', int(every) if every.isdigit() else 1, int(duree) if duree.isdigit() else 60)
+		elif action == 'stop':
+			self.stop()
+		elif action in ('texte', 'pstats'):
+			profiles = [profile for mode, profile in self.profiles.items() if poste in (None, mode)]
+			if not profiles:
+				return "Aucun resultat\n"
+			stats = pstats.Stats(profiles[0], stream=StringIO())
+			for profile in profiles[1:]:
+				stats.add(profile)
+			if action == 'pstats':
+				request.setHeader('Content-Type', 'application/octet-stream')
+				request.setHeader('Content-Disposition', 'attachment; filename="spytrep-%s.pstats"' % (poste or 'tout'))
+				return marshal.dumps(stats.stats)
+			stats.sort_stats('cumulative').print_stats(40)
+			return stats.stream.getvalue()
+		elif action == 'pile':
+			return "".join(["%s %d\n" % item for mode, stacks in sorted(self.stacks.items()) if poste in (None, mode) for item in sorted(stacks.items())])
+		return "Profilage %s : %s, %s requettes vues, modes profiles : %s\n" % (self.kind, "actif" if self.active else "arrete",
+			self.count, ", ".join(sorted(self.profiles.keys() or self.stacks.keys())) or "aucun")
+
 	
 class Serveur(Resource):
 	'''
@@ -125,35 +1408,212 @@ class Serveur(Resource):
 			Liste des attributs :			
 				timeout		: temps avant de considérer une conection comme perdu
 				player list	: Dico des joueurs conecter (clefs = string de la forme "ID_pseudo", valeurs = objets de type player)
+				expiry		: Index d'expiration (tas de tuples (échéance, code), compacté quand les entrées orphelines dominent)
+				sweeper		: Tâche périodique qui vide l'index d'expiration
+				hold		: temps de maintien maximal d'une requette en long-poll (0 = désactivé)
+				waiters		: Dico des requettes en attente (clefs = code du partenaire, valeurs = liste d'Attente)
+				roster_version	: Numéro de version de la liste des joueurs (incrémenté à chaque arrivée/départ)
+				roster_log		: Derniers changements de la liste (tuples (version, '+'/'-', code))
+				page_cache		: Page d'état publique (invalidée quand la liste des joueurs change)
+				epoch			: Date de lancement (sert à construire l'ETag de la page d'état)
+				log_handler		: Handler de log non bloquant (BatchHandler) placé devant ceux de log.cfg
+				trades			: Dico des échanges en cours (clefs = code de chaque participant, valeurs = Echange)
+				metrics			: Compteurs et histogrammes par mode (Metriques)
+				limiter			: Anti-spam par IP et par code joueur (Limiteur)
+				admission		: Nombre max de joueurs et chien de garde de surcharge (Admission)
+				pokemons		: Pokemons envoyés en attente de lecture par le partenaire (Reserve)
+				index			: Index triés des joueurs pour la page admin (Index)
+				journal			: Journal binaire des échanges (None = pas de journal)
+				capture			: Capture du trafic pour SPyReplay.py (None = pas de capture)
+				profiler		: Profilage à la demande des requettes POST (Profileur)
+				compressor		: Compression des réponses (Compresseur)
+				queues			: Files d'attente du matchmaking (clefs = critère, valeurs = OrderedDict des codes)
+				queued			: Dico des joueurs en file (clefs = code, valeurs = critère)
+				matched			: Dico des partenaires trouvés pas encore annoncés (clefs = code en attente, valeurs = partenaire)
+				snapshot_path	: Fichier de sauvegarde de l'état (None = pas de sauvegarde)
+				snapshot_busy	: Vrai pendant l'écriture d'une sauvegarde périodique
+				snapshot_lock	: Verrou d'écriture des sauvegardes (la dernière écrite est la plus récente)
+				purger			: Tâche périodique qui purge limiter
 				
 			Liste des méthodes :
 				__init__(timeout=60)	: initialise le serrveur avec un timeout (par défaut 60 secondes)
-				update()				: mets à jour la liste de joueur conectés
-				render_GET(request)		: génére une réponse aux requettes GET (ignore l'argument request)
+				add_player(code)		: ajoute un joueur et l'inscrit dans l'index d'expiration
+				remove_player(code)		: retire un joueur de la liste (et annule son échange)
+				get_trade(code,partner)	: renvoie l'échange entre code et partner s'il existe
+				request_trade(code_1,code_2,now)	: demande (ou accepte) un échange entre deux joueurs
+				close_trade(code)		: retire l'échange de code des index
+				match(code,critere,now)	: cherche un partenaire dans la file (mode match)
+				unqueue(code)			: sort un joueur de la file du matchmaking
+				busy(code)				: vrai si le joueur a un échange en cours
+				trace(event,code,partner,size)	: ajoute un événement au journal des échanges (s'il y en a un)
+				record(request,code,body,start)	: ajoute une requette et sa réponse à la capture (s'il y en a une)
+				snapshot()				: photo de l'état (joueurs et échanges) en tuples
+				save(sync)				: écrit la photo sur le disque (dans un thread sauf si sync)
+				restore(path)			: recharge une sauvegarde (seulement les joueurs pas encore en timeout)
+				load_state(state)		: remplace l'état par une photo (cf. snapshot)
+				release_all()			: répond à toutes les requettes en attente (long-poll)
+				start_snapshots(path,every)	: sauvegarde périodique et à l'arrêt du serveur
+				update()				: mets à jour la liste de joueur conectés (appelée par sweeper)
+				compact_expiry()		: reconstruit l'index d'expiration sans les entrées orphelines
+				roster_changed(op,code)	: incrémente la version de la liste et invalide les caches
+				get_roster()			: renvoie la liste des joueurs sérialisée (mise en cache)
+				roster_since(version)	: renvoie la liste ou ses changements depuis une version donnée
+				etat_partenaire(code)	: renvoie les Jeton/Timestamp et le pokemon d'un joueur
+				park(request)			: mets une requette en attente sur le partenaire
+				wake(code)				: relance les requettes en attente sur le joueur code
+				release(attente)		: libère une requette en attente à la fin du maintien
+				compress(request,body,cache)	: compresse la réponse si le client l'accepte
+				render_GET(request)		: génére une réponse aux requettes GET
+				check_admin(request)	: vérifie le masterCode d'une requette d'administration
+				render_page()			: génére la page d'état publique
+				render_admin(args)		: génére une page de la vue admin (pagination, tri, recherche)
+				render_metrics()		: génére l'export Prometheus (mode=metrics + masterCode)
+				init_batch(logger,size,sample)	: place le BatchHandler et l'échantillonnage sur le logger
 				render_POST(request)	: génére une réponse aux requettes POST
+				execute(request,ip)		: traite une requette POST (ou une opération de batch)
+				batch(request,ip)		: mode batch, plusieurs opérations par requette POST
+				refuse(request,ip,code)	: vérifie l'anti-spam et prépare la réponse de refus
+				admit(request,args)		: contrôle d'admission des nouveaux joueurs (503 si plein ou en surcharge)
 				
 			Liste des variables :
-				allows_modes 	: set des modes autorisés
+				allows_modes 	: set des modes autorisés (les autres sont comptés comme "invalid")
+				poll_modes		: set des modes pouvant être mis en attente (long-poll)
+				entry_modes		: set des modes par lesquels un joueur entre (soumis au contrôle d'admission)
+				batch_max		: nombre max d'opérations dans un batch
+				admin_size		: nombre de joueurs par page admin (par défaut, max)
+				match_wait		: secondes sans poll (mode match) avant de sortir un joueur de la file
+				roster_memo		: nombre max de réponses roster_since en cache (vidé à chaque changement)
+				snapshot_version	: version du format des sauvegardes (cf. snapshot)
 				
 			A faire :
 				System de shutdown UID pour fermer proprement le serveur
 				Page Admin pour vue complete + kick ?
-				Ban list (DOS et requette mal fomé)
 	'''
 	
-	def __init__ (self,timeout=60,log_conf='log.cfg',checkAuto=False,masterCode='{0:x}'.format(random.getrandbits(64))):
+	allows_modes = set(['connect','select','match','sent','update','valid','cancel','synchro','delete'])
+	poll_modes = set(['select','sent','update','valid','synchro'])
+	entry_modes = set(['connect','match'])
+	batch_max = 16
+	admin_size = (50, 500)
+	match_wait = 10
+	roster_memo = 256
+	snapshot_version = 1
+	
+	# Morceaux de la page d'état (cf. render_page)
+	page_head = (	"<!DOCTYPE html>\n"
+					"  <html>\n"
+					"    <head>\n"
+					"      <title>Serveur d'&eacutechange Pokemon gemme</title>\n"
+					"    </head>\n"
+					"    <body>\n"
+					"      <center>\n"
+					"        <h1>Le serveur d'&eacutechange pokemon gemme tourne</h1>\n")
+	page_head_admin = page_head.replace("<title>", "<title>Page d'administraion du ")
+	table_head = (	"        <table>\n"
+					"          <caption>Joueurs connect&eacutes</caption>\n"
+					"          <tr>\n"
+					"            <th>Pseudo(ID)</th>\n"
+					"          </tr>\n")
+	table_head_admin = table_head.replace("          </tr>\n",
+					"            <th>Vu il y a</th>\n"
+					"            <th>Friend</th>\n"
+					"            <th>Ech</th>\n"
+					"            <th>ok</th>\n"
+					"            <th>ca</th>\n"
+					"            <th>syn</th>\n"
+					"          </tr>\n")
+	row = (			"          <tr>\n"
+					"            <td>%s</td>\n"
+					"          </tr>\n")
+	row_admin = (	"          <tr>\n"
+					"            <td>%s</td>\n"
+					"            <td>%s</td>\n"
+					"            <td>%s</td>\n"
+					"            <td>%s</td>\n"
+					"            <td>%s</td>\n"
+					"            <td>%s</td>\n"
+					"            <td>%s</td>\n"
+					"          </tr>\n")
+	trade_head_admin = (	"        <table>\n"
+					"          <caption>Echanges en cours</caption>\n"
+					"          <tr>\n"
+					"            <th>Demandeur</th>\n"
+					"            <th>Demand&eacute</th>\n"
+					"            <th>Etat</th>\n"
+					"            <th>Depuis</th>\n"
+					"          </tr>\n")
+	nav_admin = (	"        <form method=\"get\">\n"
+					"          <input type=\"hidden\" name=\"mode\" value=\"admin\">\n"
+					"          <input type=\"hidden\" name=\"code\" value=\"%s\">\n"
+					"          <select name=\"tri\">%s</select>\n"
+					"          <input type=\"text\" name=\"cherche\" value=\"%s\">\n"
+					"          <input type=\"submit\" value=\"Chercher\">\n"
+					"        </form>\n"
+					"        <p>Joueurs %s &agrave %s sur %s %s %s</p>\n")
+	link_admin = "<a href=\"?%s\">%s</a>"
+	trade_row_admin = (	"          <tr>\n"
+					"            <td>%s</td>\n"
+					"            <td>%s</td>\n"
+					"            <td>%s</td>\n"
+					"            <td>%s</td>\n"
+					"          </tr>\n")
+	page_foot = (	"      </center>\n"
+					"    </body>\n"
+					"  </html>\n")
+	
+	def __init__ (self,timeout=60,log_conf='log.cfg',checkAuto=False,masterCode='{0:x}'.format(random.getrandbits(64)),sweep=1,hold=0,roster_log=1024,log_queue=10000,log_sample={},limits={},pokemons={},journal=None,compression=256,capture=None,admission={}):
 		'''initialise le serveur'''
 		self.timeout = timeout
+		self.hold = hold
+		self.waiters = {}
+		self.roster_version = 0
+		self.roster_log = deque(maxlen=roster_log)
+		self.roster_cache = None
+		self.roster_deltas = {}
+		self.page_cache = None
+		self.epoch = int(time.time())
 		self.checkAuto = checkAuto
 		self.masterCode = masterCode
 		self.player_list = {}
+		self.trades = {}
+		self.metrics = Metriques()
+		self.index = Index()
+		self.profiler = Profileur(self)
+		self.compressor = Compresseur(compression)
+		self.queues = {}
+		self.queued = {}
+		self.matched = {}
+		self.snapshot_path = None
+		self.snapshot_busy = False
+		self.snapshot_lock = threading.Lock()
+		self.expiry = []
 		self.logger = self.init_logger(log_conf)
+		self.log_handler = self.init_batch(self.logger,log_queue,log_sample)
 		self.logger.info("Serveur Lance")
 		self.logger.debug("Timeout serveur de %s secondes", timeout)
+		self.logger.debug("Verification des timeouts toutes les %s secondes", sweep)
+		self.logger.debug("Maintien des requettes en attente : %s secondes", hold)
 		self.logger.debug("L'interdiction des auto-echanges est regle sur  %s", str(checkAuto))
 		self.logger.critical("Master Code : %s",self.masterCode)
+		self.sweeper = LoopingCall(self.update)
+		self.sweeper.start(sweep, now=False)
+		self.limiter = Limiteur(self.logger, **limits)
+		self.purger = LoopingCall(self.limiter.purge)
+		self.purger.start(60, now=False)
+		self.admission = Admission(self.logger, **admission)
+		self.pokemons = Reserve(self.logger, **pokemons)
+		self.journal = None
+		if journal:
+			self.journal = Journal(self.logger, journal)
+			reactor.addSystemEventTrigger('after', 'shutdown', self.journal.close)
+		self.capture = None
+		if capture:
+			self.capture = Capture(self.logger, capture)
+			reactor.addSystemEventTrigger('after', 'shutdown', self.capture.close)
+		reactor.addSystemEventTrigger('after', 'shutdown', self.log_handler.close)
 		
-	def init_logger(self,log_conf):
+	@staticmethod
+	def init_logger(log_conf):
 		if os.access(log_conf,os.F_OK):
 			logging.config.fileConfig(log_conf) 
 			logger = logging.getLogger()
@@ -182,90 +1642,499 @@ class Serveur(Resource):
 			logger = logging.getLogger()
 			logger.warning("Le fichier de configuration du log n'existe pas. Creation de ce dernier")
 		return logger
+	
+	@staticmethod
+	def init_batch(logger,size,sample):
+		'''
+			Déplace les handlers configurés (log.cfg ou version Hard-coder) derrière un BatchHandler
+			et ajoute l'échantillonnage des messages fréquents (sample = {mode: N})
+		'''
+		# Un seul échantillonnage et un seul BatchHandler par processus, même avec plusieurs
+		# Serveur (SPyReplay, SPyBench) : le précédent est retiré et son thread arrêté
+		for echantillon in [f for f in logger.filters if isinstance(f, Echantillon)]:
+			logger.removeFilter(echantillon)
+		if sample:
+			logger.addFilter(Echantillon(sample))
+		handlers = logger.handlers[:]
+		if len(handlers) == 1 and handlers[0] is BatchHandler.active:
+			return handlers[0]
+		for handler in handlers:
+			logger.removeHandler(handler)
+		if BatchHandler.active is not None:
+			BatchHandler.active.close()
+		batch = BatchHandler([handler for handler in handlers if not isinstance(handler, BatchHandler)], size)
+		BatchHandler.active = batch
+		logger.addHandler(batch)
+		return batch
+
+	def add_player(self,code,last_seen=None):
+		'''
+			Ajoute un joueur à la liste et l'inscrit dans l'index d'expiration
+			
+			Le code est interné : la clef de player_list, Player.code, friend, les index
+			des échanges et d'expiration partagent tous la même chaîne
+			last_seen sert à la reprise d'une sauvegarde (cf. restore)
+		'''
+		code = intern(code)
+		player = Player(code)
+		if last_seen is not None:
+			player.last_seen = last_seen
+		self.player_list[code] = player
+		self.index.add(code)
+		heapq.heappush(self.expiry, (player.last_seen + self.timeout, code))
+		if len(self.expiry) > 2 * len(self.player_list) + 64:
+			self.compact_expiry()
+		self.roster_changed('+', code)
+		return player
+
+	def remove_player(self,code,event=Journal.ANNULE):
+		'''
+			Retire un joueur de la liste (son entrée d'expiration sera ignorée par update)
+			event : événement du journal si un échange en cours est annulé (cf. trace)
+		'''
+		player = self.player_list.pop(code, None)
+		if player is not None:
+			self.roster_changed('-', code)
+			self.index.remove(player.code)
+			self.pokemons.free(code)
+			self.unqueue(code)
+			self.matched.pop(code, None)
+			trade = self.trades.pop(code, None)
+			if trade is not None and trade.state < Echange.SYNCHRO:
+				# Le partenaire verra l'échange annulé (valid renvoie "false")
+				trade.cancel = code
+				trade.set_state(Echange.ANNULE, time.time())
+				self.trace(event, code, trade.partner(code))
+		return player
+	
+	def get_trade(self,code,partner):
+		'''Renvoie l'échange entre code et partner (None s'il n'y en a pas)'''
+		trade = self.trades.get(code)
+		if trade is not None and trade.partner(code) == partner:
+			return trade
+		return None
+	
+	def request_trade(self,code_1,code_2,now):
+		'''
+			code_1 demande un échange à code_2 (mode select)
+			
+			Si code_2 a déjà demandé code_1 (et le demande toujours) l'échange est accepté,
+			sinon une nouvelle demande est créée. Renvoie l'échange de code_1.
+		'''
+		trade = self.get_trade(code_1, code_2)
+		if trade is not None and trade.state < Echange.SYNCHRO:
+			return trade
+		
+		# Nouvelle demande : on abandonne l'échange précédent de code_1 (terminé, annulé ou avec un autre)
+		self.close_trade(code_1)
+		trade = self.get_trade(code_2, code_1)
+		if trade is not None and trade.state == Echange.DEMANDE and now - self.player_list[code_2].ech < self.timeout:
+			trade.set_state(Echange.ACCEPTE, now)
+			self.trace(Journal.ACCEPTE, code_1, code_2, now=now)
+		else:
+			trade = Echange(code_1, code_2, now)
+			self.trace(Journal.DEMANDE, code_1, code_2, now=now)
+		self.trades[code_1] = trade
+		self.player_list[code_1].friend = code_2
+		return trade
+	
+	def match(self,code,critere,now):
+		'''
+			Matchmaking (mode match) : renvoie le partenaire de code, ou None s'il attend
+			
+			Le premier joueur de la file du même critère encore actif est pris en O(1)
+			(les joueurs qui ne pollent plus depuis match_wait secondes sont sortis au
+			passage), l'échange est créé comme par deux select croisés. Celui qui attendait
+			apprend son partenaire à son poll suivant (matched) ; si ce partenaire est
+			parti entre temps (delete, timeout) on repart dans la file.
+		'''
+		partner = self.matched.pop(code, None)
+		if partner in self.player_list:
+			return partner
+		# Déjà en échange (poll répété) : on garde le partenaire actuel
+		if self.busy(code):
+			return self.trades[code].partner(code)
+		queue = self.queues.get(critere)
+		while queue:
+			partner = next(iter(queue))
+			if partner != code and now - self.player_list[partner].ech <= self.match_wait and not self.busy(partner):
+				break
+			self.unqueue(partner)
+			queue = self.queues.get(critere)
+		else:
+			# Personne : on attend dans la file (en dernier si on y était déjà sous un autre critère)
+			if self.queued.get(code) != critere:
+				self.unqueue(code)
+				self.queued[code] = critere
+				self.queues.setdefault(critere, OrderedDict())[code] = None
+			return None
+		self.unqueue(partner)
+		self.unqueue(code)
+		self.request_trade(partner, code, now)
+		self.request_trade(code, partner, now)
+		self.player_list[partner].set_ech(now)
+		self.matched[partner] = code
+		return partner
+	
+	def busy(self,code):
+		'''Vrai si code a un échange accepté pas encore terminé'''
+		trade = self.trades.get(code)
+		return trade is not None and trade.active() and trade.state < Echange.SYNCHRO
+	
+	def unqueue(self,code):
+		'''Sort code de la file du matchmaking (s'il y est)'''
+		critere = self.queued.pop(code, None)
+		if critere is not None:
+			queue = self.queues[critere]
+			del queue[code]
+			if not queue:
+				del self.queues[critere]
+	
+	def close_trade(self,code):
+		'''Retire l'échange de code des index (et de celui de son partenaire si c'est le même)'''
+		trade = self.trades.pop(code, None)
+		if trade is not None:
+			partner = trade.partner(code)
+			if self.trades.get(partner) is trade:
+				del self.trades[partner]
+		return trade
+	
+	def trace(self,event,code,partner,size=0,now=None):
+		'''Ajoute un événement au journal des échanges (cf. Journal)'''
+		if self.journal is not None:
+			self.journal.add(event, code, partner, size, now)
+	
+	def record(self,request,code,body,start=None,parked=False):
+		'''Ajoute une requette et sa réponse (avant compression) à la capture'''
+		if self.capture is not None:
+			self.capture.add(request, code, body, start, parked)
+	
+	def snapshot(self):
+		'''
+			Photo de l'état sous forme de tuples (sérialisable par marshal)
+				(version du format, date, joueurs, échanges)
+			Chaque échange est accompagné des codes sous lesquels il est indexé.
+		'''
+		trades = {}
+		for code, trade in self.trades.items():
+			trades.setdefault(id(trade), (trade, []))[1].append(code)
+		return (self.snapshot_version, time.time(),
+			[(player.code, player.last_seen, self.pokemons.peek(player.code), player.friend, player.ech, player.ok, player.ca, player.syn) for player in self.player_list.values()],
+			[(trade.players, trade.state, tuple(trade.sent), tuple(trade.valid), tuple(trade.syn), trade.cancel, trade.since, tuple(codes)) for trade, codes in trades.values()])
+	
+	def save(self,sync=False):
+		'''
+			Ecrit la photo de l'état dans snapshot_path
+			
+			La photo est prise sur le thread du reactor (copie en tuples), l'écriture et
+			le fsync se font dans un thread sauf à l'arrêt (sync) où on attend la fin.
+			Le fichier est remplacé d'un coup (rename) : une sauvegarde n'est jamais à moitié écrite.
+			Les écritures se font une par une (snapshot_lock) : la sauvegarde de l'arrêt attend
+			celle du thread, sinon le rename de cette dernière, plus ancienne, pourrait passer après.
+		'''
+		if self.snapshot_path is None or (self.snapshot_busy and not sync):
+			return
+		data = self.snapshot()
+		if sync:
+			self.write_snapshot(data, self.snapshot_path)
+		else:
+			self.snapshot_busy = True
+			reactor.callInThread(self.write_snapshot, data, self.snapshot_path)
+	
+	def write_snapshot(self,data,path):
+		'''Ecrit une photo de l'état (appelée dans un thread par save)'''
+		self.snapshot_lock.acquire()
+		try:
+			fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path), dir=os.path.dirname(os.path.abspath(path)))
+			with os.fdopen(fd, 'wb') as f:
+				marshal.dump(data, f)
+				f.flush()
+				os.fsync(f.fileno())
+			os.rename(tmp, path)
+			self.logger.debug("Sauvegarde de %s joueurs dans %s", len(data[2]), path)
+		except (IOError, OSError) as e:
+			self.logger.error("Impossible d'ecrire la sauvegarde %s : %s", path, e)
+		finally:
+			self.snapshot_lock.release()
+			self.snapshot_busy = False
+	
+	def restore(self,path):
+		'''
+			Recharge une sauvegarde au démarrage : les joueurs vus depuis moins de timeout
+			reprennent là où ils en étaient (échanges compris), les autres sont oubliés
+		'''
+		try:
+			with open(path, 'rb') as f:
+				state = marshal.load(f)
+			self.load_state(state, path)
+		except (IOError, EOFError, ValueError, TypeError) as e:
+			self.logger.warning("Pas de sauvegarde chargee depuis %s : %s", path, e)
+	
+	def load_state(self,state,source):
+		'''
+			Remplace l'état par une photo (cf. snapshot), venant d'une sauvegarde ou d'une
+			passation : les joueurs en timeout sont oubliés, ainsi que leurs échanges
+			Une photo d'une autre version du format lève ValueError (état inchangé).
+		'''
+		if not isinstance(state, tuple) or not state or state[0] != self.snapshot_version:
+			raise ValueError("format de sauvegarde %r inconnu (attendu %s)" % (state[0] if isinstance(state, tuple) and state else state, self.snapshot_version))
+		version, saved, players, trades = state
+		for code in self.player_list.keys():
+			self.remove_player(code)
+		self.trades.clear()
+		now = time.time()
+		# Dans l'ordre des dernières requettes pour que Index.recent reste trié
+		for (code, last_seen, pkm, friend, ech, ok, ca, syn) in sorted(players, key=lambda player: player[1]):
+			if now - last_seen > self.timeout:
+				continue
+			player = self.add_player(code, last_seen)
+			if pkm:
+				self.pokemons.put(player.code, pkm)
+			player.friend = friend and intern(friend)
+			player.ech, player.ok, player.ca, player.syn = ech, ok, ca, syn
+		for (codes, state, sent, valid, syn, cancel, since, index) in trades:
+			index = [code for code in index if code in self.player_list]
+			if not index:
+				continue
+			trade = Echange(intern(codes[0]), intern(codes[1]), since)
+			trade.state = state
+			trade.sent, trade.valid, trade.syn = set(sent), set(valid), set(syn)
+			trade.cancel = cancel
+			for code in index:
+				self.trades[self.player_list[code].code] = trade
+		self.logger.warning("Reprise de %s joueurs sur %s et %s echanges depuis %s (etat de %s secondes)",
+			len(self.player_list), len(players), len(set(self.trades.values())), source, int(now - saved))
+	
+	def start_snapshots(self,path,every):
+		'''Sauvegarde l'état toutes les every secondes (0 = seulement à l'arrêt) et à l'arrêt du serveur'''
+		self.snapshot_path = path
+		if every:
+			self.snapshotter = LoopingCall(self.save)
+			self.snapshotter.start(every, now=False)
+		reactor.addSystemEventTrigger('before', 'shutdown', self.save, True)
+	
+	def roster_changed(self,op,code):
+		'''Incrémente la version de la liste des joueurs et invalide les caches'''
+		self.roster_version += 1
+		self.roster_log.append((self.roster_version, op, code))
+		self.roster_cache = None
+		self.roster_deltas = {}
+		self.page_cache = None
+	
+	def get_roster(self):
+		'''Renvoie la liste des Codes des joueurs présents (reconstruite uniquement si elle a changé)'''
+		if self.roster_cache is None:
+			self.roster_cache = str(self.player_list.keys())
+		return self.roster_cache
+	
+	def roster_since(self,version):
+		'''
+			Renvoie la liste des joueurs pour un client qui connait déjà la version donnée
+			
+			La réponse commence par la version courante suivie d'une ligne :
+				unchanged					: rien n'a changé depuis cette version
+				delta + 2 lignes			: liste des arrivées puis liste des départs
+				full + 1 ligne				: liste complète (version inconnue ou trop ancienne)
+		'''
+		current = self.roster_version
+		if not version.isdigit() or len(version) > 20:
+			return "%d\nfull\n%s" % (current, self.get_roster())
+		# Clef numérique : "1", "01", "001"... partagent la même entrée du cache
+		version = int(version)
+		if version in self.roster_deltas:
+			return self.roster_deltas[version]
+		if version > current or (self.roster_log and version < self.roster_log[0][0] - 1) or (not self.roster_log and version != current):
+			# pas de mise en cache : version inconnue
+			return "%d\nfull\n%s" % (current, self.get_roster())
+		elif version == current:
+			ret = "%d\nunchanged" % current
+		else:
+			# Etat de chaque code à la version demandée : déduit de sa première opération
+			before = {}
+			for (v, op, code) in self.roster_log:
+				if v > version and code not in before:
+					before[code] = (op == '-')
+			joins = [code for code in before if not before[code] and code in self.player_list]
+			leaves = [code for code in before if before[code] and code not in self.player_list]
+			ret = "%d\ndelta\n%s\n%s" % (current, str(joins), str(leaves))
+		if len(self.roster_deltas) < self.roster_memo:
+			self.roster_deltas[version] = ret
+		return ret
 
 	def update(self):
-		'''Mets à jour la liste des joueurs présents'''
-		self.logger.debug('Mise a jour de la liste de joueurs')
-		for (code, player) in self.player_list.items():
-			if time.time() - player.last_seen > self.timeout:
+		'''
+			Mets à jour la liste des joueurs présents
+			
+			Appelée périodiquement par le reactor (sweeper) et non plus à chaque requette :
+			on ne dépile que les entrées échues de l'index d'expiration.
+			Un joueur vu depuis son inscription est ré-inscrit avec sa nouvelle échéance,
+			une entrée orpheline (joueur déconnecté) est simplement jetée.
+		'''
+		now = time.time()
+		expiry = self.expiry
+		while expiry and expiry[0][0] < now:
+			deadline, code = heapq.heappop(expiry)
+			player = self.player_list.get(code)
+			if player is None:
+				continue
+			if now - player.last_seen > self.timeout:
 				self.logger.warning("Timeout de %s",player)
-				del self.player_list[code]
+				self.metrics.timeouts += 1
+				self.remove_player(code, Journal.TIMEOUT)
+			else:
+				heapq.heappush(expiry, (player.last_seen + self.timeout, code))
 		return
+	
+	def compact_expiry(self):
+		'''
+			Reconstruit l'index d'expiration avec une entrée par joueur connecté
+			
+			Les entrées des joueurs partis ne sont jetées qu'à leur échéance : un client qui
+			enchaine connect/delete les ferait grossir pendant tout un timeout. Appelée quand
+			elles sont deux fois plus nombreuses que les joueurs (coût amorti O(1)).
+		'''
+		self.expiry = [(player.last_seen + self.timeout, code) for code, player in self.player_list.iteritems()]
+		heapq.heapify(self.expiry)
 		
 	def render_GET(self, request):
 		'''
-			Génére une réponse aux requettes GET (ignore l'argument request)
+			Génére une réponse aux requettes GET
 			
 			La réponse se présente sous la forme d'une page HTML comprenant un tableau avec
 			la liste des joueurs présent, leur ID et la date de la dernière requette reçu
 			
+			La page publique ne change qu'avec la liste des joueurs : elle est mise en cache
+			et servie avec un ETag (réponse 304 si le client a déjà la bonne version)
+			
 			Si la requete comporte les arguments nessaire la page d'amin s'affiche
 		'''	
 		self.logger.debug("Requette GET recue : %s", request.args)
 		
-		# Mise à jour des joueurs présent à chaque requettes reçus
-		self.update()
+		if self.refuse(request, request.getClientIP(), None):
+			return ""
 		
 		# mode admin (warning si faux code)
-		admin = False
 		if 'mode' in request.args.keys() and request.args['mode'][0]=='admin':
-			if 'code' in request.args.keys() and request.args['code'][0]==self.masterCode:
-				admin = True
-				self.logger.info("Connection a la page admin", request.args)
-			else:
-				self.logger.warning("Tentative de connection a la page admin echoue", request.args)
-		
-		# Mise en forme de la page principale
-		text = 	"<!DOCTYPE html>\n"
-		text +=	"  <html>\n"
-		text +=	"    <head>\n"
-		if admin:
-			text +=	"      <title>Page d'administraion du Serveur d'&eacutechange Pokemon gemme</title>\n"
-		else:
-			text +=	"      <title>Serveur d'&eacutechange Pokemon gemme</title>\n"
-		text +=	"    </head>\n"
-		text +=	"    <body>\n"
-		text +=	"      <center>\n"
-		text +=	"        <h1>Le serveur d'&eacutechange pokemon gemme tourne</h1>\n"
+			if self.check_admin(request):
+				self.logger.info("Connection a la page admin")
+				return self.compress(request, self.render_admin(request.args), False)
+		
+		# métriques pour Prometheus (même protection que la page admin)
+		if 'mode' in request.args.keys() and request.args['mode'][0]=='metrics':
+			if self.check_admin(request):
+				request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+				return self.compress(request, self.render_metrics(), False)
+		
+		# profilage à la demande (même protection que la page admin)
+		if 'mode' in request.args.keys() and request.args['mode'][0]=='profil':
+			if self.check_admin(request):
+				return self.profiler.render(request)
+		
+		if self.page_cache is None:
+			self.page_cache = self.render_page()
+		# Une version compressée est une autre représentation : ETag différent
+		encoding = self.compressor.choose(request, self.page_cache)
+		if request.setETag('"%x-%d%s"' % (self.epoch, self.roster_version, '-' + encoding if encoding else '')) is CACHED:
+			self.record(request, 304, "")
+			return ""
+		self.record(request, 200, self.page_cache)
+		return self.compressor.encode(request, self.page_cache, encoding)
+	
+	def compress(self,request,body,cache=True):
+		'''Compresse la réponse si elle est assez grosse et que le client l'accepte (cf. Compresseur)'''
+		return self.compressor.encode(request, body, self.compressor.choose(request, body), cache)
+	
+	def check_admin(self,request):
+		'''Vérifie le masterCode d'une requette d'administration'''
+		if 'code' in request.args.keys() and request.args['code'][0]==self.masterCode:
+			return True
+		self.logger.warning("Tentative de connection a la page admin echoue : %s", request.args)
+		return False
+	
+	def render_page(self):
+		'''Génére la page d'état publique (le tableau est assemblé en une seule fois par join)'''
+		text = [self.page_head]
 		if len(self.player_list)==0:
-			text +=	"          Aucun joueurs connect&eacutes\n"
+			text.append("          Aucun joueurs connect&eacutes\n")
 		else:
-			text +=	"        <table>\n"
-			text +=	"          <caption>Joueurs connect&eacutes</caption>\n"
-			text +=	"          <tr>\n"
-			text +=	"            <th>Pseudo(ID)</th>\n"
-			if admin:
-				text +=	"            <th>Seen</th>\n"
-				text +=	"            <th>Friend</th>\n"
-				text +=	"            <th>Ech</th>\n"
-				text +=	"            <th>ok</th>\n"
-				text +=	"            <th>ca</th>\n"
-				text +=	"            <th>syn</th>\n"
-			text +=	"          </tr>\n"
-			for player in self.player_list.values():
-				text +=	"          <tr>\n"
-				text +=	"            <td>"+str(player)+"</td>\n"
-				if admin:
-					text +=	"            <td>"+str(player.last_seen)+"</td>\n" #amélioré la visualistion de cette date
-					text +=	"            <td>"+str(player.friend)+"</td>\n" #amélioré la visualistion de cette date
-					text +=	"            <td>"+str(player.ech)+"</td>\n" #amélioré la visualistion de cette date
-					text +=	"            <td>"+str(player.ok)+"</td>\n" #amélioré la visualistion de cette date
-					text +=	"            <td>"+str(player.ca)+"</td>\n" #amélioré la visualistion de cette date
-					text +=	"            <td>"+str(player.syn)+"</td>\n" #amélioré la visualistion de cette date
-			text +=	"          </tr>\n"
-		text +=	"        </table>\n"
-		text +=	"      </center>\n"
-		text +=	"    </body>\n"
-		text +=	"  </html>\n"
-		return text
+			text.append(self.table_head)
+			row = self.row
+			text.extend([row % player for player in self.player_list.values()])
+			text.append("        </table>\n")
+		text.append(self.page_foot)
+		return "".join(text)
+	
+	def render_admin(self,args):
+		'''
+			Génére une page de la vue admin : seuls les joueurs de la page (et leurs échanges)
+			sont parcourus, grâce aux index triés (cf. Index)
+				tri		: seen (les plus récents d'abord, par défaut), id ou nom
+				cherche	: préfixe de l'id (tri=id) ou du nom (sinon)
+				page	: numéro de page (à partir de 1)
+				taille	: nombre de joueurs par page (admin_size)
+		'''
+		tri = args.get('tri', ['seen'])[0]
+		if tri not in ('seen', 'id', 'nom'):
+			tri = 'seen'
+		prefix = args.get('cherche', [''])[0]
+		page = args.get('page', ['1'])[0]
+		page = int(page) if page.isdigit() and int(page) > 0 else 1
+		size = args.get('taille', [''])[0]
+		size = min(int(size), self.admin_size[1]) if size.isdigit() and int(size) > 0 else self.admin_size[0]
+		codes, total = self.index.page(tri, prefix, (page - 1) * size, size)
+		
+		now = time.time()
+		age = lambda date: "%.0fs" % (now - date) if date else "-"
+		query = lambda page: urllib.urlencode([('mode', 'admin'), ('code', self.masterCode), ('tri', tri), ('cherche', prefix), ('page', page), ('taille', size)])
+		text = [self.page_head_admin]
+		text.append(self.nav_admin % (cgi.escape(self.masterCode, True),
+			"".join(["<option%s>%s</option>" % (" selected" if option == tri else "", option) for option in ('seen', 'id', 'nom')]),
+			cgi.escape(prefix, True), min((page - 1) * size + 1, total), (page - 1) * size + len(codes), total,
+			self.link_admin % (query(page - 1), "&lt;") if page > 1 else "",
+			self.link_admin % (query(page + 1), "&gt;") if page * size < total else ""))
+		if codes:
+			players = [self.player_list[code] for code in codes]
+			text.append(self.table_head_admin)
+			row = self.row_admin
+			text.extend([row % (player, age(player.last_seen), player.friend, age(player.ech), age(player.ok), age(player.ca), age(player.syn)) for player in players])
+			text.append("        </table>\n")
+			trades = []
+			for code in codes:
+				trade = self.trades.get(code)
+				if trade is not None and trade not in trades:
+					trades.append(trade)
+			if trades:
+				text.append(self.trade_head_admin)
+				row = self.trade_row_admin
+				text.extend([row % (trade.players[0], trade.players[1], trade.states[trade.state], age(trade.since)) for trade in trades])
+				text.append("        </table>\n")
+		text.append(self.page_foot)
+		return "".join(text)
+	
+	def render_metrics(self):
+		'''Génére l'export Prometheus des compteurs et des jauges du serveur'''
+		trades = set(self.trades.values())
+		return self.metrics.render([
+			("spytrep_players", "Joueurs connectes", len(self.player_list)),
+			("spytrep_trades_active", "Echanges acceptes en cours", len([trade for trade in trades if trade.active()])),
+			("spytrep_trades", "Echanges references (demandes, en cours, termines ou annules)", len(trades)),
+			("spytrep_roster_version", "Version de la liste des joueurs", self.roster_version),
+			("spytrep_roster_bytes", "Taille de la liste des joueurs serialisee", len(self.get_roster())),
+			("spytrep_match_queued", "Joueurs en attente d'un partenaire (mode match)", len(self.queued)),
+			("spytrep_parked_requests", "Requettes en attente (long-poll)", sum([len(waiters) for waiters in self.waiters.values()])),
+			("spytrep_log_dropped", "Messages de log perdus (file pleine)", self.log_handler.dropped),
+			("spytrep_pokemon_bytes", "Taille des pokemons en memoire", self.pokemons.total),
+			("spytrep_pokemon_spilled", "Pokemons deportes dans le fichier", len(self.pokemons.spilled)),
+			("spytrep_pokemon_refused", "Pokemons refuses (trop gros ou reserve pleine)", self.pokemons.refused),
+			("spytrep_compression_saved_bytes", "Octets economises par la compression des reponses", self.compressor.saved),
+			("spytrep_compression_cache_hits", "Reponses compressees servies depuis le cache", self.compressor.hits),
+			("spytrep_journal_written", "Evenements ecrits dans le journal des echanges", self.journal.written if self.journal else 0),
+			("spytrep_journal_dropped", "Evenements du journal perdus (file pleine)", self.journal.dropped if self.journal else 0),
+			("spytrep_reactor_lag_seconds", "Retard moyen du reactor (chien de garde, 0 si desactive)", self.admission.lag),
+			("spytrep_overloaded", "1 pendant une surcharge (nouveaux joueurs refuses)", int(self.admission.overloaded)),
+			("spytrep_admission_refused", "Requettes refusees par le controle d'admission (503)", self.admission.refused),
+		])
 		
-		self.last_seen = time.time()
-		self.pkm = ""
-		self.friend = ""
-		self.ech = 0
-		self.ok  = 0
-		self.ca  = 0
-		self.syn = 0
 
 	def render_POST(self, request):
 		'''
@@ -277,15 +2146,182 @@ class Serveur(Resource):
 		
 		self.logger.debug("Requette POST recue : %s", request.args)
 		
-		# Mise à jour des joueurs présent à chaque requettes reçus
-		self.update()
+		ip = request.getClientIP()
+		if request.args.get('mode', [None])[0] == 'batch':
+			ret = self.batch(request, ip)
+			self.record(request, request.code, ret)
+			return self.compress(request, ret)
 		
+		# Anti-spam avant toute analyse de la requette
+		code = request.args.get('monCode', [None])[0]
+		if self.refuse(request, ip, code):
+			return ""
+		if not self.admit(request, request.args):
+			return ""
+		
+		start = time.time()
+		ret = self.execute(request, ip)
+		
+		# Long-poll (optionnel, demandé par le client avec l'argument 'attente') :
+		# plutôt que de renvoyer une réponse vide on garde la requette jusqu'à ce que
+		# le partenaire bouge, la réponse finale est identique à celle d'un poll classique
+		if ret == "" and self.hold and 'attente' in request.args and request.args['mode'][0] in self.poll_modes:
+			self.park(request, start)
+			return NOT_DONE_YET
+		
+		self.logger.debug("Retour -> %s",ret)
+		self.record(request, 200, ret, start)
+		return self.compress(request, ret)
+	
+	def execute(self,request,ip):
+		'''Traite une requette (ou une opération d'un batch) : process, métriques, infractions et réveil des long-poll'''
 		# on fait une fonction pour avoir un return,
 		# donc un code plus propreet plus simple
+		start = time.time()
 		ret = self.process(request)
+		mode = request.args.get('mode', [None])[0]
+		error = ret.startswith("Requette")
+		self.metrics.observe(mode if mode in self.allows_modes else 'invalid', time.time() - start, error)
 		
-		self.logger.debug("Retour -> %s",ret)
+		# Une requette mal formée compte comme une infraction de l'IP
+		if error:
+			self.limiter.offense(('ip', ip), start)
+		
+		# Le joueur a peut-être bougé : on relance ceux qui l'attendent
+		if 'monCode' in request.args:
+			player = self.player_list.get(request.args['monCode'][0])
+			if player is not None and player.last_seen >= start:
+				self.index.touch(player.code)
+			self.wake(request.args['monCode'][0])
 		return ret
+	
+	def batch(self,request,ip):
+		'''
+			Mode batch : chaque argument 'op' est une requette complète encodée comme un
+			corps POST classique (ex : op=mode%3Dupdate%26monCode%3D...), les opérations
+			sont traitées dans l'ordre et les réponses renvoyées en une seule fois sous
+			forme de netstrings ("<longueur>:<réponse>," par opération).
+			L'anti-spam compte chaque opération, le batch entier est refusé au besoin.
+			Pas de long-poll : une opération qui attend son partenaire renvoie "".
+		'''
+		ops = request.args.get('op', [])
+		if not ops or len(ops) > self.batch_max:
+			self.limiter.offense(('ip', ip), time.time())
+			error = "Requette invalide : entre 1 et %s operations par batch" % self.batch_max
+			self.logger.warning(error)
+			return error
+		ops = [Requete(None, 'POST', urlparse.parse_qs(op, keep_blank_values=True), {}, ip, None) for op in ops]
+		for op in ops:
+			if self.refuse(request, ip, op.args.get('monCode', [None])[0]):
+				return ""
+			if not self.admit(request, op.args):
+				return ""
+		results = [self.execute(op, ip) for op in ops]
+		self.logger.debug("Retour batch -> %s", results)
+		return "".join(["%d:%s," % (len(ret), ret) for ret in results])
+	
+	def refuse(self,request,ip,code):
+		'''Vérifie l'anti-spam, en cas de refus prépare la réponse (429 ou 403 + Retry-After) et renvoie True'''
+		refus = self.limiter.check(ip, code, time.time())
+		if refus is None:
+			return False
+		request.setResponseCode(refus[0])
+		request.setHeader('Retry-After', str(refus[1]))
+		if request.args.get('mode', [None])[0] != 'batch':
+			self.record(request, refus[0], "")
+		return True
+	
+	def admit(self,request,args):
+		'''
+			Contrôle d'admission des modes d'entrée (connect, match), renvoie False après
+			avoir préparé la réponse (503 + Retry-After) si la requette est refusée :
+				- serveur plein : seuls les nouveaux joueurs sont refusés
+				- surcharge : les joueurs sans échange (friend vide) sont refusés aussi, on
+				  garde quand même leur présence à jour pour qu'ils ne tombent pas en timeout
+			Les joueurs en plein échange et les autres modes passent toujours.
+		'''
+		if args.get('mode', [None])[0] not in self.entry_modes:
+			return True
+		code = args.get('monCode', [None])[0]
+		player = self.player_list.get(code)
+		if player is not None and (player.friend or not self.admission.overloaded):
+			return True
+		retry = self.admission.check(len(self.player_list))
+		if retry is None:
+			return True
+		if player is not None:
+			player.seen()
+			self.index.touch(player.code)
+		self.logger.debug("Admission refusee a %s (%s joueurs, retard %d ms)", code, len(self.player_list), self.admission.lag * 1000)
+		request.setResponseCode(503)
+		request.setHeader('Retry-After', str(retry))
+		if request.args.get('mode', [None])[0] != 'batch':
+			self.record(request, 503, "")
+		return False
+	
+	def etat_partenaire(self,code):
+		'''Renvoie les Jeton/Timestamp et le pokemon du joueur code (None s'il n'est pas connecté)'''
+		player = self.player_list.get(code)
+		if player is None:
+			return None
+		return (player.ech, player.ok, player.ca, player.syn, code in self.pokemons)
+	
+	def park(self,request,start=None):
+		'''Mets la requette en attente sur le partenaire (sonCode)'''
+		code = request.args['sonCode'][0]
+		attente = Attente(request, code, self.etat_partenaire(code), start)
+		attente.call = reactor.callLater(self.hold, self.release, attente)
+		self.waiters.setdefault(code, []).append(attente)
+		request.notifyFinish().addErrback(self.drop, attente)
+		self.logger.debug("Mise en attente de %s sur %s", request.args['monCode'][0], code)
+		
+	def unpark(self,attente):
+		'''Retire une requette de la liste d'attente'''
+		waiters = self.waiters.get(attente.code)
+		if waiters is not None and attente in waiters:
+			waiters.remove(attente)
+			if not waiters:
+				del self.waiters[attente.code]
+	
+	def drop(self,reason,attente):
+		'''Le client a fermé la connexion pendant l'attente'''
+		self.unpark(attente)
+		if attente.call.active():
+			attente.call.cancel()
+	
+	def wake(self,code):
+		'''Relance les requettes en attente sur le joueur code si son état a changé'''
+		if code not in self.waiters:
+			return
+		etat = self.etat_partenaire(code)
+		for attente in list(self.waiters[code]):
+			if attente.etat == etat:
+				continue
+			attente.etat = etat
+			ret = self.process(attente.request)
+			if ret != "":
+				self.unpark(attente)
+				attente.call.cancel()
+				self.reply(attente, ret)
+	
+	def release(self,attente):
+		'''Fin du maintien : on rejoue la requette et on renvoie la réponse quelle qu'elle soit'''
+		self.unpark(attente)
+		self.reply(attente, self.process(attente.request))
+	
+	def release_all(self):
+		'''Répond tout de suite à toutes les requettes en attente (arrêt, passation)'''
+		for waiters in self.waiters.values():
+			for attente in list(waiters):
+				attente.call.cancel()
+				self.release(attente)
+	
+	def reply(self,attente,ret):
+		'''Termine une requette mise en attente'''
+		self.logger.debug("Retour -> %s",ret)
+		self.record(attente.request, 200, ret, attente.start, True)
+		attente.request.write(self.compress(attente.request, ret))
+		attente.request.finish()
 		
 	def process(self, request):
 		'''
@@ -297,6 +2333,7 @@ class Serveur(Resource):
 		'''
 		session = {}
 		session['cles'] = request.args.keys()
+		now = time.time()
 		
 		# On vérifie que le mode est spécifié
 		if "mode" in session['cles']:
@@ -323,14 +2360,17 @@ class Serveur(Resource):
 			# Ajout du joueur à la liste si pas déja présent
 			# Mise à jour des infos dans le cas contraire
 			if session['monCode'] not in self.player_list:
-				self.player_list[session['monCode']]=Player(session['monCode'])
+				self.add_player(session['monCode'])
 				self.logger.info("Connexion de : %s", self.player_list[session['monCode']])
 			else:
-				self.player_list[session['monCode']].seen()
+				self.player_list[session['monCode']].seen(now)
 				self.logger.debug("Mise a jour de %s", self.player_list[session['monCode']])
 				
 			# On renvoie la liste des Codes de tous les joueurs présents
-			return str(self.player_list.keys())
+			# (ou seulement ses changements si le client donne la version qu'il connait)
+			if 'version' in session['cles']:
+				return self.roster_since(request.args['version'][0])
+			return self.get_roster()
 			
 		elif session['mode'] == "select":
 			# Requette de Demande d'échange
@@ -343,17 +2383,38 @@ class Serveur(Resource):
 			player_1 = self.player_list[session['monCode']]
 			player_2 = self.player_list[session['sonCode']]
 			self.logger.info("%s demande echange a %s", player_1, player_2)
-			player_1.seen()
-			player_1.set_ech()
-			player_1.friend = player_2
+			player_1.seen(now)
+			player_1.set_ech(now)
+			trade = self.request_trade(session['monCode'], session['sonCode'], now)
 			
-			if time.time() - player_2.ech < self.timeout and player_2.friend == player_1:
+			if trade.active():
 				self.logger.info("%s accepte %s", player_1, player_2)
 				return "true"
 			else:
-				self.logger.info("%s attend %s", player_1, player_2)
+				self.logger.info("%s attend %s", player_1, player_2, extra={'mode': session['mode']})
 				return ""
 			
+		elif session['mode'] == "match":
+			# Recherche d'un partenaire au hasard (sans télécharger la liste des joueurs) :
+			# renvoie son code quand il est trouvé, l'échange est alors déjà accepté
+			# et continue normalement (sent, update...) avec sonCode = ce code
+			if not self.check_list(['monCode'],session,request):
+				self.logger.warning(session['check_error'])
+				return session['check_error']
+			
+			if session['monCode'] not in self.player_list:
+				self.add_player(session['monCode'])
+				self.logger.info("Connexion de : %s", self.player_list[session['monCode']])
+			player_1 = self.player_list[session['monCode']]
+			player_1.seen(now)
+			player_1.set_ech(now)
+			partner = self.match(player_1.code, request.args.get('critere', [''])[0][:32], now)
+			if partner is None:
+				self.logger.debug("%s attend un partenaire", player_1, extra={'mode': session['mode']})
+				return ""
+			self.logger.info("%s echange avec %s (matchmaking)", player_1, self.player_list.get(partner, partner))
+			return partner
+			
 		elif session['mode'] == "sent":
 			# on vérifie le code perso, le code ami et les data sur le pokemon
 			if not self.check_list(['monCode','sonCode','pokemon'],session,request):
@@ -369,13 +2430,25 @@ class Serveur(Resource):
 			#	logger.warning("Auto echange %s", player_1)			# de pseudo donc désactivation dans ce script
 			#	return "Auto echange interdit"						# Décomenter pour réactiver
 
-			player_1.set_ech()
-			logger.info("%s envoie son pokemon", player_1)
-			if player_1.pkm !="" and  time.time() - player_2.ech < self.timeout and player_2.friend == player_1.id:
-				self.logger.debug("%s regarde le pokemon de %s", player_1, player_2)
-				return player_2.pkm
+			player_1.seen(now)
+			player_1.set_ech(now)
+			self.logger.info("%s envoie son pokemon", player_1)
+			trade = self.get_trade(session['monCode'], session['sonCode'])
+			if trade is not None and trade.active():
+				if not self.pokemons.put(session['monCode'], session['pokemon']):
+					error = "Requette '%s' invalide : pokemon de %s octets refuse (trop gros ou reserve pleine)" % (session['mode'], len(session['pokemon']))
+					self.logger.warning(error)
+					return error
+				if session['monCode'] not in trade.sent:
+					self.trace(Journal.ENVOI, session['monCode'], session['sonCode'], len(session['pokemon']), now)
+				trade.sent.add(session['monCode'])
+				if len(trade.sent) == 2:
+					trade.set_state(Echange.ENVOYE, now)
+			if trade is not None and trade.active() and session['sonCode'] in trade.sent:
+				self.logger.debug("%s regarde le pokemon de %s", player_1, player_2, extra={'mode': session['mode']})
+				return self.pokemons.get(session['sonCode'])
 			else:
-				self.logger.debug("%s attend le pokemon de %s", player_1, player_2)
+				self.logger.debug("%s attend le pokemon de %s", player_1, player_2, extra={'mode': session['mode']})
 				return ""
 				
 		elif session['mode'] == "update":
@@ -393,13 +2466,14 @@ class Serveur(Resource):
 			#	logger.warning("Auto echange %s", player_1)			# de pseudo donc désactivation dans ce script
 			#	return "Auto echange interdit"						# Décomenter pour réactiver
 			
-			player_1.set_ech()
-			self.logger.info("%s envoie son pokemon", player_1)
-			if player_2.pkm !="" and player_2.ech !=0 and time.time() - player_2.ech < self.timeout and player_2.friend == player_1.id:
-				self.logger.info("%s regarde le pokemon de %s", player_1, player_2)
-				return player_1.pkm
+			player_1.seen(now)
+			player_1.set_ech(now)
+			trade = self.get_trade(session['monCode'], session['sonCode'])
+			if trade is not None and trade.active() and session['sonCode'] in trade.sent:
+				self.logger.info("%s regarde le pokemon de %s", player_1, player_2, extra={'mode': session['mode']})
+				return self.pokemons.get(session['sonCode'])
 			else:
-				self.logger.info("%s attend le pokemon de %s", player_1, player_2)
+				self.logger.info("%s attend le pokemon de %s", player_1, player_2, extra={'mode': session['mode']})
 				return ""
 				
 		elif session['mode'] == "valid":
@@ -417,12 +2491,18 @@ class Serveur(Resource):
 			#	logger.warning("Auto echange %s", player_1)			# de pseudo donc désactivation dans ce script
 			#	return "Auto echange interdit"						# Décomenter pour réactiver
 			
-			player_1.seen()
-			player_1.set_ok()
-			
-			if player_2.ca !=0 and player_2.ca > player_2.ech and player_2.friend == player_1.id:
+			player_1.seen(now)
+			player_1.set_ok(now)
+			trade = self.get_trade(session['monCode'], session['sonCode'])
+			if trade is None:
+				return ""
+			if trade.state == Echange.ANNULE:
 				return "false"
-			elif player_2.ok !=0 and time.time() - player_2.ok < self.timeout and player_2.friend == player_1.id:
+			if session['monCode'] not in trade.valid:
+				self.trace(Journal.VALIDE, session['monCode'], session['sonCode'], now=now)
+			trade.valid.add(session['monCode'])
+			if session['sonCode'] in trade.valid:
+				trade.set_state(Echange.VALIDE, now)
 				return "true"
 			else:
 				return ""
@@ -442,16 +2522,23 @@ class Serveur(Resource):
 			# de pseudo donc ici on se base sur l'id uniquement
 			if self.checkAuto and  player_1.id == player_2.id:							
 				player_1.reset_all()								
-				logger.warning("Auto echange %s", player_1)			
+				self.pokemons.free(session['monCode'])
+				self.logger.warning("Auto echange %s", player_1)			
 				return "Auto echange interdit"						
 			
-			player_1.seen()
-			player_1.set_ca()
+			player_1.seen(now)
+			player_1.set_ca(now)
+			trade = self.get_trade(session['monCode'], session['sonCode'])
+			if trade is not None and trade.state != Echange.ANNULE:
+				self.logger.info("%s annule l'echange avec %s", player_1, player_2)
+				trade.cancel = session['monCode']
+				trade.set_state(Echange.ANNULE, now)
+				self.trace(Journal.ANNULE, session['monCode'], session['sonCode'], now=now)
 			
 			return "true"
 			
 		elif session['mode'] == "synchro":
-			if not self.check_list(['monCode','sonCode'],session):
+			if not self.check_list(['monCode','sonCode'],session,request):
 				self.logger.warning(session['check_error'])
 				return session['check_error']
 				
@@ -464,11 +2551,20 @@ class Serveur(Resource):
 			# de pseudo donc ici on se base sur l'id uniquement
 			if self.checkAuto and  player_1.id == player_2.id:							
 				player_1.reset_all()								
-				logger.warning("Auto echange %s", player_1)			
+				self.pokemons.free(session['monCode'])
+				self.logger.warning("Auto echange %s", player_1)			
 				return "Auto echange interdit"						
 				
-			player_1.set_syn()
-			if time.time() - player_2.syn < self.timeout :
+			player_1.seen(now)
+			player_1.set_syn(now)
+			trade = self.get_trade(session['monCode'], session['sonCode'])
+			if trade is None or not trade.active():
+				return ""
+			trade.syn.add(session['monCode'])
+			if session['sonCode'] in trade.syn:
+				if trade.state < Echange.SYNCHRO:
+					self.trace(Journal.SYNCHRO, session['monCode'], session['sonCode'], now=now)
+				trade.set_state(Echange.SYNCHRO, now)
 				return "true"
 			else:
 				return ""
@@ -478,16 +2574,26 @@ class Serveur(Resource):
 			if not self.check_list(['monCode'],session,request):
 				self.logger.warning(session['check_error'])
 				return session['check_error']
-			player_1 = self.player_list[session['monCode']]
+			player_1 = self.player_list.get(session['monCode'])
+			
+			# Un échange pas encore terminé est annulé (et journalisé) avant d'être retiré des index
+			trade = self.trades.get(session['monCode'])
+			if trade is not None and trade.state < Echange.SYNCHRO:
+				trade.cancel = session['monCode']
+				trade.set_state(Echange.ANNULE, now)
+				self.trace(Journal.ANNULE, session['monCode'], trade.partner(session['monCode']), now=now)
 			
-			if self.check_list(['sonCode'],session,request):
-				player_2 = self.player_list[session['sonCode']]
-				if player_2.friend == player_1.id:
+			# Le partenaire repart de zéro
+			trade = self.close_trade(session['monCode'])
+			if trade is not None:
+				player_2 = self.player_list.get(trade.partner(session['monCode']))
+				if player_2 is not None and player_2.friend == session['monCode']:
 					player_2.reset_all()
+					self.pokemons.free(player_2.code)
 			
-			if session['monCode'] in self.player_list:
+			if player_1 is not None:
 				self.logger.info("Deconexion de %s", player_1)
-				del player_1, self.player_list[session['monCode']]
+				self.remove_player(session['monCode'])
 			return ""
 		
 		else:
@@ -510,15 +2616,26 @@ class Serveur(Resource):
 					if arg == 'monCode' or arg == 'sonCode':
 						if not self.check_code(arg,session,request):
 							return False
-					session[arg]=request.args[arg][0]
+					else:
+						session[arg]=request.args[arg][0]
 			else:
 				session['check_error'] = "Requette '%s' invalide : l'argument '%s' est manquant" % (session['mode'], arg)
 				return False
 		return True
 		
 	def check_code(self,arg,session,request):
-		'''Vérifie que le code est Valide'''
+		'''
+			Vérifie que le code est Valide et le range dans session[arg]
+			
+			Le code d'un joueur connecté a déjà été vérifié à sa connexion : on ne le
+			re-découpe pas, on reprend directement sa version internée
+		'''
 		code = request.args[arg][0]
+		player = self.player_list.get(code)
+		if player is not None:
+			session[arg] = player.code
+			return True
+		
 		#check format id_Pseudo
 		if '_' not in code:
 			session['check_error'] = "Requette '%s' invalide : '%s' n'est pas un code valide pour '%s'" % (session['mode'], code, arg)
@@ -539,19 +2656,743 @@ class Serveur(Resource):
 					return False
 			
 		#Check de connection du joueur (bug en select)
-		if (session['mode'] not in ['connect','delete']) and (code not in self.player_list) :
+		if (session['mode'] not in ['connect','delete','match']) and (code not in self.player_list) :
 			session['check_error'] = "Requette '%s' invalide : {%s : %s} ne correspond pas a un joueur conecte" % (session['mode'], arg, code)
 			return False
 		
+		session[arg] = code
 		return True
 
 
+class Requete:
+	'''
+		Classe Requete
+			Description :
+				Requette HTTP reçue par un worker et rejouée dans le processus qui détient
+				l'état. Imite la partie de twisted.web.server.Request utilisée par Serveur
+				pour que render_GET/render_POST (long-poll compris) marchent sans changement.
+
+			Liste des attributs :
+				id			: Numéro de la requette chez le worker
+				method		: Méthode HTTP (GET/POST)
+				args		: Arguments de la requette (même forme que request.args)
+				headers		: Entêtes reçus (clefs en minuscule)
+				ip			: Adresse du client
+				code		: Code de réponse HTTP
+				out_headers	: Entêtes de la réponse
+				body		: Morceaux du corps de la réponse
+				reply		: Fonction appelée quand la réponse est prête
+	'''
+
+	def __init__ (self,id,method,args,headers,ip,reply):
+		self.id = id
+		self.method = method
+		self.args = args
+		self.headers = headers
+		self.ip = ip
+		self.code = 200
+		self.out_headers = {}
+		self.body = []
+		self.reply = reply
+		self.finished = False
+		self.waiting = []
+
+	def getClientIP (self):
+		return self.ip
+
+	def getHeader (self,name):
+		return self.headers.get(name.lower())
+
+	def setHeader (self,name,value):
+		self.out_headers[name] = value
+
+	def setResponseCode (self,code,message=None):
+		self.code = code
+
+	def setETag (self,etag):
+		'''Même comportement que Request.setETag : 304 si le client a déjà cette version'''
+		self.setHeader('ETag', etag)
+		tags = self.getHeader('if-none-match')
+		if tags and etag in tags.split():
+			self.setResponseCode(304)
+			return CACHED
+		return None
+
+	def write (self,data):
+		self.body.append(data)
+
+	def finish (self):
+		self.finished = True
+		self.reply(self)
+		for d in self.waiting:
+			d.callback(None)
+
+	def notifyFinish (self):
+		d = Deferred()
+		self.waiting.append(d)
+		return d
+
+	def lost (self):
+		'''Le client a fermé la connexion chez le worker'''
+		for d in self.waiting:
+			d.errback(Exception("connexion perdue"))
+		self.waiting = []
+
+
+class Collecte:
+	'''
+		Classe Collecte
+			Description :
+				Remplace le logger de Serveur dans le processus qui détient l'état quand il y
+				a des workers : pendant le traitement d'une requette relayée les messages sont
+				seulement formatés (les arguments, des Player par exemple, changent ensuite)
+				et gardés dans records, ils repartent avec la réponse et c'est le worker qui
+				les fait passer par ses handlers (cf. Relais.emit). Le processus de l'état ne
+				paye ni LogRecord, ni verrou, ni écriture. En dehors d'une requette (timeouts,
+				sauvegardes) les messages vont directement au vrai logger.
+				
+			Liste des attributs :
+				logger	: Vrai logger du processus
+				level	: Niveau min d'un message écrit (logger et handlers)
+				records	: Messages de la requette en cours : (niveau, texte, mode, date), None hors requette
+				
+			Liste des méthodes :
+				log(level,msg,args,extra)	: formate et garde le message (ou le passe au logger)
+				debug, info, warning, error, critical, exception : comme logging.Logger
+	'''
+	
+	def __init__ (self,logger):
+		self.logger = logger
+		self.level = max(logger.getEffectiveLevel(), min([handler.level for handler in logger.handlers] or [logging.NOTSET]))
+		self.records = None
+	
+	def __getattr__ (self,name):
+		return getattr(self.logger, name)
+	
+	def log (self,level,msg,args,extra):
+		if level < self.level:
+			return
+		if self.records is None:
+			self.logger.log(level, msg, *args, extra=extra)
+			return
+		try:
+			text = msg % args if args else msg
+		except Exception:
+			text = "%s %r" % (msg, args)
+		self.records.append((level, text, extra.get('mode') if extra else None, time.time()))
+	
+	def debug (self,msg,*args,**kwargs):
+		# Le plus fréquent et en général filtré : pas d'appel de plus
+		if self.level <= logging.DEBUG:
+			self.log(logging.DEBUG, msg, args, kwargs.get('extra'))
+	
+	def info (self,msg,*args,**kwargs):
+		self.log(logging.INFO, msg, args, kwargs.get('extra'))
+	
+	def warning (self,msg,*args,**kwargs):
+		self.log(logging.WARNING, msg, args, kwargs.get('extra'))
+	
+	def error (self,msg,*args,**kwargs):
+		self.log(logging.ERROR, msg, args, kwargs.get('extra'))
+	
+	def critical (self,msg,*args,**kwargs):
+		self.log(logging.CRITICAL, msg, args, kwargs.get('extra'))
+	
+	def exception (self,msg,*args,**kwargs):
+		# La pile n'a de sens que dans ce processus
+		self.logger.exception(msg, *args, **kwargs)
+
+
+class EtatServeur(NetstringReceiver):
+	'''
+		Connexion d'un worker vers le processus qui détient l'état (côté état)
+		
+		Messages reçus (marshal) :
+			(id, method, args, headers, ip)		: requette à traiter
+			(id,)								: le client de la requette id est parti
+		Messages envoyés :
+			(id, code, headers, body, logs)		: réponse à la requette id et messages de log
+												  à écrire par le worker (cf. Collecte)
+			(None, 0, {}, "", logs)				: messages de log d'une requette mise en attente
+	'''
+	MAX_LENGTH = 1 << 24
+
+	def connectionMade (self):
+		self.pending = {}
+		self.logs = []
+
+	def stringReceived (self,data):
+		message = marshal.loads(data)
+		if len(message) == 1:
+			requete = self.pending.pop(message[0], None)
+			if requete is not None:
+				requete.lost()
+			return
+		requete = Requete(*(message + (self.send,)))
+		self.pending[requete.id] = requete
+		collecte = self.factory.serveur.logger
+		collecte.records = []
+		try:
+			if requete.method == 'POST':
+				ret = self.factory.serveur.render_POST(requete)
+			else:
+				ret = self.factory.serveur.render_GET(requete)
+		finally:
+			self.logs, collecte.records = collecte.records, None
+		if ret is not NOT_DONE_YET:
+			requete.write(ret)
+			requete.finish()
+		elif self.logs:
+			self.sendString(marshal.dumps((None, 0, {}, "", self.logs)))
+			self.logs = []
+
+	def send (self,requete):
+		self.pending.pop(requete.id, None)
+		if self.transport.connected:
+			self.sendString(marshal.dumps((requete.id, requete.code, requete.out_headers, "".join(requete.body), self.logs)))
+		self.logs = []
+
+	def connectionLost (self,reason):
+		for requete in self.pending.values():
+			requete.lost()
+		self.pending = {}
+
+
+class EtatFactory(Factory):
+	'''Accepte les workers sur la socket Unix (l'état reste dans serveur)'''
+	protocol = EtatServeur
+
+	def __init__ (self,serveur):
+		self.serveur = serveur
+
+
+class EtatClient(NetstringReceiver):
+	'''Connexion d'un worker vers le processus qui détient l'état (côté worker)'''
+	MAX_LENGTH = 1 << 24
+
+	def connectionMade (self):
+		self.factory.relais.client = self
+
+	def stringReceived (self,data):
+		id, code, headers, body, logs = marshal.loads(data)
+		self.factory.relais.emit(logs)
+		if id is not None:
+			self.factory.relais.respond(id, code, headers, body)
+
+	def connectionLost (self,reason):
+		# Sans l'état le worker ne sert à rien (on laisse passer un éventuel
+		# arrêt déjà demandé par signal, cf. Relais.stop)
+		self.factory.relais.client = None
+		reactor.callLater(0, self.factory.relais.stop)
+
+
+class Relais(Resource):
+	'''
+		Classe Relais
+			Description :
+				Remplace Serveur dans les workers : les requettes HTTP sont décodées ici puis
+				transmises au processus qui détient l'état (player_list, échanges), qui ne
+				fait que les changements d'état. Tout le reste est fait ici : écriture du log
+				(messages formatés par Collecte), compression des réponses POST (la page
+				publique reste compressée par l'état, à cause de son ETag) et réponse HTTP.
+
+			Liste des attributs :
+				client		: Connexion vers le processus qui détient l'état (EtatClient)
+				pending		: Dico des requettes en cours (clefs = id, valeurs = requette twisted)
+				next_id		: Numéro de la prochaine requette
+				logger		: Logger du worker (même log.cfg que l'état)
+				compressor	: Compression des réponses POST (cf. Compresseur)
+	'''
+	isLeaf = True
+
+	def __init__ (self,path,logger,compression):
+		Resource.__init__(self)
+		self.client = None
+		self.pending = {}
+		self.next_id = 0
+		self.logger = logger
+		self.compressor = Compresseur(compression)
+		factory = ClientFactory()
+		factory.protocol = EtatClient
+		factory.relais = self
+		reactor.connectUNIX(path, factory)
+	
+	def stop (self):
+		'''Arrête le worker s'il n'est pas déjà en train de s'arrêter'''
+		try:
+			reactor.stop()
+		except ReactorNotRunning:
+			pass
+
+	def render_GET (self,request):
+		return self.forward(request)
+
+	def render_POST (self,request):
+		return self.forward(request)
+
+	def forward (self,request):
+		'''Transmet la requette au processus qui détient l'état'''
+		if self.client is None:
+			request.setResponseCode(503)
+			return ""
+		self.next_id += 1
+		id = self.next_id
+		self.pending[id] = request
+		headers = dict([(name.lower(), values[-1]) for name, values in request.requestHeaders.getAllRawHeaders()])
+		if request.method == 'POST':
+			# Compressée ici (cf. respond)
+			headers.pop('accept-encoding', None)
+		self.client.sendString(marshal.dumps((id, request.method, request.args, headers, request.getClientIP())))
+		request.notifyFinish().addErrback(self.lost, id)
+		return NOT_DONE_YET
+
+	def lost (self,reason,id):
+		'''Le client est parti avant la réponse (long-poll) : on prévient l'état'''
+		if self.pending.pop(id, None) is not None and self.client is not None:
+			self.client.sendString(marshal.dumps((id,)))
+
+	def emit (self,logs):
+		'''Ecrit les messages de log venus de l'état (cf. Collecte) dans les handlers du worker'''
+		for level, text, mode, created in logs:
+			self.logger.handle(logging.makeLogRecord({'name': self.logger.name, 'levelno': level, 'levelname': logging.getLevelName(level),
+				'msg': text, 'mode': mode, 'created': created, 'msecs': (created - int(created)) * 1000}))
+
+	def respond (self,id,code,headers,body):
+		request = self.pending.pop(id, None)
+		if request is None:
+			return
+		request.setResponseCode(code)
+		for name, value in headers.items():
+			request.setHeader(name, value)
+		if request.method == 'POST':
+			body = self.compressor.encode(request, body, self.compressor.choose(request, body))
+		# Même format que sans workers : Content-Length plutôt que chunked
+		request.setHeader('Content-Length', str(len(body)))
+		if body:
+			request.write(body)
+		request.finish()
+
+
+def run_worker(fd,path,log_conf='log.cfg',log_queue=10000,log_sample={},compression=256):
+	'''Worker : sert HTTP sur la socket héritée fd et relaie vers l'état sur la socket Unix path'''
+	logger = Serveur.init_logger(log_conf)
+	log_handler = Serveur.init_batch(logger, log_queue, log_sample)
+	reactor.addSystemEventTrigger('after', 'shutdown', log_handler.close)
+	root = Resource()
+	root.putChild("index.php", Relais(path, logger, compression))
+	reactor.adoptStreamPort(fd, socket.AF_INET, Site(root))
+	reactor.run()
+
+
+def spawn_workers(serveur,workers,port,path,args=[]):
+	'''
+		Lance workers processus qui acceptent tous sur la même socket d'écoute (héritée)
+		et relaient leurs requettes vers serveur au travers de la socket Unix path.
+		args : arguments de la ligne de commande à passer aux workers (log, compression).
+		Le logger de serveur est remplacé par une Collecte : ses messages sont écrits
+		par les workers.
+	'''
+	# Le port d'abord : si il est pris on n'a pas retiré la socket Unix d'un serveur en place
+	listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	listener.bind(('', port))
+	listener.listen(1024)
+	listener.setblocking(False)
+	
+	if os.path.exists(path):
+		os.remove(path)
+	serveur.logger = Collecte(serveur.logger)
+	reactor.listenUNIX(path, EtatFactory(serveur))
+	
+	# Pas besoin de tuer les workers à l'arrêt : ils s'arrêtent d'eux même quand
+	# la socket Unix se ferme (cf. EtatClient.connectionLost)
+	for i in range(workers):
+		reactor.spawnProcess(ProcessProtocol(), sys.executable,
+			[sys.executable, os.path.abspath(__file__), 'worker_fd=3', 'etat=' + path] + args,
+			env=os.environ, childFDs={0: 0, 1: 1, 2: 2, 3: listener.fileno()})
+	serveur.logger.info("%s workers lances sur le port %s", workers, port)
+	return listener
+
+
+class HTTPBrut(Protocol,TimeoutMixin):
+	'''
+		Moteur HTTP minimal (moteur=brut) : HTTP/1.1 avec keep-alive directement sur la
+		connexion TCP, sans twisted.web (pas de Request, de Site ni d'arbre de Resource).
+		Les requettes sont rejouées dans Serveur au travers de Requete comme pour les
+		workers, une seule à la fois par connexion (les suivantes attendent dans le buffer,
+		y compris derrière un long-poll). Comme twisted.web : les corps en
+		Transfer-Encoding: chunked sont décodés (501 pour les autres encodages) et HEAD
+		est servi par render_GET, sans le corps mais avec son Content-Length ; les autres
+		méthodes reçoivent un 501.
+	'''
+	max_head = 8192
+	max_body = 65536
+	idle = 60
+
+	def connectionMade (self):
+		self.buffer = ""
+		self.current = None
+		self.keep = True
+		self.parsing = False
+		self.factory.channels.add(self)
+		self.setTimeout(self.idle)
+
+	def dataReceived (self,data):
+		self.resetTimeout()
+		self.buffer += data
+		self.next()
+
+	def next (self):
+		'''Traite les requettes complètes du buffer tant qu'aucune n'est en cours'''
+		self.parsing = True
+		try:
+			while self.current is None and self.keep and not self.transport.disconnecting:
+				end = self.buffer.find("\r\n\r\n")
+				if end < 0:
+					if len(self.buffer) > self.max_head:
+						self.error(431)
+					return
+				lines = self.buffer[:end].split("\r\n")
+				try:
+					method, target, version = lines[0].split()
+					headers = dict([(name.strip().lower(), value.strip()) for name, value in [line.split(":", 1) for line in lines[1:]]])
+					encoding = headers.get('transfer-encoding', '').lower()
+					if encoding and encoding != 'chunked':
+						self.error(501)
+						return
+					if encoding:
+						# Le Content-Length est ignoré quand le corps est chunked
+						request = self.chunks(end + 4)
+						if request is None:
+							if len(self.buffer) > end + 4 + 2 * self.max_body:
+								self.error(413)
+							return
+					else:
+						length = int(headers.get('content-length', 0))
+						if length > self.max_body or length < 0:
+							self.error(413)
+							return
+						if len(self.buffer) < end + 4 + length:
+							return
+						request = (self.buffer[end + 4:end + 4 + length], end + 4 + length)
+				except ValueError:
+					self.error(400)
+					return
+				body, size = request
+				if len(body) > self.max_body:
+					self.error(413)
+					return
+				self.buffer = self.buffer[size:]
+				self.dispatch(method, target, version, headers, body)
+		finally:
+			self.parsing = False
+
+	def chunks (self,start):
+		'''
+			Décode un corps chunked qui commence à start dans le buffer : (corps, fin),
+			None s'il n'est pas encore complet, ValueError s'il est mal formé
+		'''
+		body = []
+		while True:
+			end = self.buffer.find("\r\n", start)
+			if end < 0:
+				return None
+			length = int(self.buffer[start:end].split(";", 1)[0], 16)
+			if length < 0:
+				raise ValueError(length)
+			start = end + 2
+			if not length:
+				break
+			if len(self.buffer) < start + length + 2:
+				return None
+			if self.buffer[start + length:start + length + 2] != "\r\n":
+				raise ValueError("chunk")
+			body.append(self.buffer[start:start + length])
+			start += length + 2
+		# Trailers éventuels jusqu'à la ligne vide
+		while True:
+			end = self.buffer.find("\r\n", start)
+			if end < 0:
+				return None
+			if end == start:
+				return "".join(body), end + 2
+			start = end + 2
+
+	def dispatch (self,method,target,version,headers,body):
+		connection = headers.get('connection', '').lower()
+		self.keep = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+		path, _, query = target.partition('?')
+		args = urlparse.parse_qs(query, keep_blank_values=True)
+		if method == 'POST' and headers.get('content-type', '').startswith('application/x-www-form-urlencoded'):
+			for name, values in urlparse.parse_qs(body, keep_blank_values=True).items():
+				args.setdefault(name, []).extend(values)
+		self.current = requete = Requete(None, method, args, headers, self.transport.getPeer().host, self.respond)
+		self.setTimeout(None)
+		if path != '/index.php':
+			requete.setResponseCode(404)
+			ret = "No Such Resource"
+		elif method == 'POST':
+			ret = self.factory.serveur.render_POST(requete)
+		elif method in ('GET', 'HEAD'):
+			ret = self.factory.serveur.render_GET(requete)
+		else:
+			# Comme Request.supportedMethods de twisted.web
+			requete.setResponseCode(501)
+			ret = ""
+		if ret is not NOT_DONE_YET:
+			requete.write(ret)
+			requete.finish()
+
+	def respond (self,requete):
+		'''Envoie la réponse (appelée par Requete.finish) puis passe à la requette suivante'''
+		body = "".join(requete.body)
+		requete.out_headers.setdefault('Content-Type', 'text/html')
+		head = ["HTTP/1.1 %d %s" % (requete.code, RESPONSES.get(requete.code, ""))]
+		head.extend(["%s: %s" % header for header in requete.out_headers.items()])
+		head.append("Content-Length: %d" % len(body))
+		if not self.keep:
+			head.append("Connection: close")
+		if requete.method == 'HEAD':
+			body = ""
+		self.transport.write("\r\n".join(head) + "\r\n\r\n" + body)
+		self.current = None
+		if not self.keep:
+			self.transport.loseConnection()
+			return
+		self.setTimeout(self.idle)
+		if not self.parsing:
+			# Réponse d'un long-poll : des requettes ont pu arriver entre temps
+			self.next()
+
+	def error (self,code):
+		self.transport.write("HTTP/1.1 %d %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n" % (code, RESPONSES.get(code, "")))
+		self.transport.loseConnection()
+
+	def connectionLost (self,reason):
+		self.setTimeout(None)
+		self.factory.channels.discard(self)
+		if self.current is not None:
+			self.current.lost()
+			self.current = None
+
+
+class MoteurBrut(Factory):
+	'''Factory du moteur HTTP minimal, connait ses connexions ouvertes (cf. Passation)'''
+	protocol = HTTPBrut
+
+	def __init__ (self,serveur):
+		self.serveur = serveur
+		self.channels = set()
+
+
+class Canal(HTTPChannel):
+	'''Connexion HTTP qui s'inscrit auprès de son Site (cf. SiteSuivi)'''
+
+	def connectionMade (self):
+		HTTPChannel.connectionMade(self)
+		self.factory.channels.add(self)
+
+	def connectionLost (self,reason):
+		self.factory.channels.discard(self)
+		HTTPChannel.connectionLost(self,reason)
+
+
+class SiteSuivi(Site):
+	'''Site qui connait ses connexions ouvertes, pour pouvoir les fermer lors d'une passation'''
+	protocol = Canal
+
+	def __init__ (self,*args,**kwargs):
+		Site.__init__(self,*args,**kwargs)
+		self.channels = set()
+
+
+class Cedant(NetstringReceiver):
+	'''
+		Côté ancien processus de la passation (cf. Passation)
+			1. envoie la socket d'écoute ('socket')
+			2. à la réception ('recu') : arrête d'accepter, répond aux long-poll, envoie l'état ('etat')
+			3. ferme ses connexions HTTP et s'arrête dès qu'elles sont fermées
+	'''
+	MAX_LENGTH = 1 << 30
+
+	def connectionMade (self):
+		passation = self.factory.passation
+		if passation.done:
+			self.transport.loseConnection()
+			return
+		passation.serveur.logger.warning("Passation demandee par un nouveau processus")
+		self.transport.sendFileDescriptor(passation.port.fileno())
+		self.sendString(marshal.dumps(('socket',)))
+
+	def stringReceived (self,data):
+		if marshal.loads(data)[0] == 'recu':
+			self.factory.passation.cede(self)
+
+	def connectionLost (self,reason):
+		# L'état est parti (loseConnection attend que tout soit écrit)
+		if self.factory.passation.done:
+			self.factory.passation.drain()
+
+
+class Releve(NetstringReceiver):
+	'''Côté nouveau processus de la passation (cf. Passation)'''
+	MAX_LENGTH = 1 << 30
+	fd = None
+
+	def fileDescriptorReceived (self,fd):
+		self.fd = fd
+
+	def stringReceived (self,data):
+		message = marshal.loads(data)
+		if message[0] == 'socket' and self.fd is not None:
+			self.sendString(marshal.dumps(('recu',)))
+		elif message[0] == 'etat':
+			self.factory.releve(self.fd, message[1])
+			self.fd = None
+			self.transport.loseConnection()
+
+	def connectionLost (self,reason):
+		# Socket reçue mais pas l'état : elle ne servira pas
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+
+implementer(IFileDescriptorReceiver)(Releve)
+
+
+class Passation(ClientFactory):
+	'''
+		Classe Passation
+			Description :
+				Mise à jour sans coupure : le nouveau processus se connecte à l'ancien sur la
+				socket Unix path, reçoit la socket d'écoute (les connexions en attente restent
+				dans la file du noyau, aucun client n'est refusé) puis l'état. L'ancien arrête
+				d'accepter, répond aux long-poll, ferme ses connexions et s'arrête.
+				Si personne ne répond sur path, ou si la connexion est perdue avant la fin
+				de la passation, le processus écoute normalement sur port.
+				Dans tous les cas il attend ensuite la passation suivante sur path.
+			
+			Liste des attributs :
+				serveur		: Serveur qui détient l'état
+				site		: Factory HTTP qui connait ses connexions (SiteSuivi ou MoteurBrut)
+				path		: Socket Unix de la passation
+				port		: Port d'écoute HTTP (None tant qu'il n'est pas ouvert)
+				unix		: Port d'écoute de la socket Unix
+				done		: Vrai quand l'état a été cédé au nouveau processus
+				
+			Liste des méthodes :
+				start(port)		: se connecte à l'ancien processus (ou écoute sur port s'il n'y en a pas)
+				listen()		: attend la passation suivante sur path
+				releve(fd,etat)	: (nouveau) adopte la socket d'écoute et l'état reçus
+				cede(proto)		: (ancien) cède l'état et ferme ses connexions
+				drain()			: (ancien) s'arrête dès que ses connexions sont fermées
+	'''
+	protocol = Releve
+
+	def __init__ (self,serveur,site,path):
+		self.serveur = serveur
+		self.site = site
+		self.path = path
+		self.port = None
+		self.unix = None
+		self.done = False
+
+	def start (self,port):
+		self.tcp = port
+		if os.path.exists(self.path):
+			reactor.connectUNIX(self.path, self)
+		else:
+			self.clientConnectionFailed(None, None)
+
+	def clientConnectionFailed (self,connector,reason):
+		# Pas d'ancien processus : démarrage normal
+		try:
+			self.port = reactor.listenTCP(self.tcp, self.site)
+		except CannotListenError as e:
+			self.serveur.logger.critical("Ecoute impossible sur le port %s : %s", self.tcp, e.socketError)
+			reactor.callWhenRunning(reactor.stop)
+			return
+		self.listen()
+	
+	def clientConnectionLost (self,connector,reason):
+		# Ancien processus parti avant de céder (déjà cédé, arrêté...) : plutôt que
+		# d'attendre pour rien on démarre normalement
+		if self.port is None:
+			self.serveur.logger.warning("Passation interrompue : %s", reason.getErrorMessage())
+			self.clientConnectionFailed(connector, reason)
+
+	def listen (self):
+		if os.path.exists(self.path):
+			os.remove(self.path)
+		factory = Factory()
+		factory.protocol = Cedant
+		factory.passation = self
+		self.unix = reactor.listenUNIX(self.path, factory)
+
+	def releve (self,fd,etat):
+		try:
+			self.serveur.load_state(etat, self.path)
+		except ValueError as e:
+			# L'écoute est reprise quand même : mieux vaut perdre l'état que les clients
+			self.serveur.logger.error("Etat de la passation ignore : %s", e)
+		self.port = reactor.adoptStreamPort(fd, socket.AF_INET, self.site)
+		os.close(fd)
+		self.serveur.logger.warning("Passation terminee, ecoute reprise sur le port %s", self.tcp)
+		self.listen()
+
+	def cede (self,proto):
+		self.done = True
+		# On arrête seulement d'accepter : stopListening ferait un shutdown() de la socket,
+		# partagée avec le nouveau processus, qui y arrêterait aussi l'écoute. Hors du
+		# reactor elle n'est pas fermée à l'arrêt, le noyau la libère avec le processus.
+		self.port.stopReading()
+		self.unix.stopListening()
+		# Plus de sauvegarde : c'est le nouveau processus qui détient l'état
+		self.serveur.snapshot_path = None
+		self.serveur.release_all()
+		proto.sendString(marshal.dumps(('etat', self.serveur.snapshot())))
+		proto.transport.loseConnection()
+		# Les réponses déjà écrites partent avant la fermeture (loseConnection attend le buffer)
+		for channel in list(self.site.channels):
+			channel.transport.loseConnection()
+		self.serveur.logger.warning("Etat cede, arret apres fermeture de %s connexions", len(self.site.channels))
+
+	def drain (self):
+		'''Attend la fermeture des connexions HTTP (10 secondes au plus) puis arrête le processus'''
+		self.stop = LoopingCall(self.drained)
+		self.stop.start(0.1)
+		reactor.callLater(10, self.drained, True)
+
+	def drained (self,force=False):
+		'''Arrête l'ancien processus quand toutes ses connexions sont fermées'''
+		if (force or not self.site.channels) and reactor.running:
+			reactor.stop()
+
+
 def main():
 	#config par défaut puis parsing des args
 	TIMEOUT 	= 3600 										# timeout des joueurs (60s en temps normal suffisent,3600 pourle debug)
 	LOG_CONF 	= 'log.cfg'									# Fichier de configuration du log	
 	CHECK_AUTO 	= False										# Interdire les auto-échanges
 	MASTER_CODE = '{0:x}'.format(random.getrandbits(64))	# Master code aléatoire
+	SWEEP		= 1											# Période (en secondes) de vérification des timeouts
+	HOLD		= 0											# Maintien max des requettes en long-poll (0 = désactivé)
+	LOG_QUEUE	= 10000										# Taille de la file des messages de log en attente d'écriture
+	LOG_SAMPLE	= {}										# Echantillonnage des messages fréquents par mode ({mode: N})
+	PORT		= 80										# Port d'écoute (80 pour le jeu)
+	WORKERS		= 0											# Nombre de processus HTTP (0 = un seul processus)
+	ETAT		= 'spytrep.sock'							# Socket Unix entre les workers et l'état
+	WORKER_FD	= None										# Socket d'écoute héritée (usage interne des workers)
+	LIMITS		= {}										# Anti-spam (cf. Limiteur, rien n'est limité par défaut)
+	SNAPSHOT	= None										# Fichier de sauvegarde de l'état (None = pas de sauvegarde)
+	SNAPSHOT_EVERY = 30										# Période des sauvegardes en secondes
+	POKEMONS	= {}										# Limites des pokemons en attente (cf. Reserve)
+	JOURNAL		= None										# Journal binaire des échanges (None = pas de journal)
+	COMPRESSION	= 256										# Taille min des réponses compressées (0 = pas de compression)
+	ADMISSION	= {}										# Contrôle d'admission (cf. Admission, rien n'est limité par défaut)
+	CAPTURE		= None										# Capture du trafic pour SPyReplay.py (None = pas de capture)
+	MOTEUR		= 'web'										# Moteur HTTP : web (twisted.web) ou brut (HTTPBrut)
+	PASSATION	= None										# Socket Unix de mise à jour sans coupure (cf. Passation, sans workers)
 	for arg in sys.argv[1:]:
 		var = arg.split('=')
 		if len(var) == 2:
@@ -563,17 +3404,109 @@ def main():
 				CHECK_AUTO = ('true'==var[1])
 			elif var[0]=='master_code':
 				MASTER_CODE = var[1]
+			elif var[0]=='sweep' and var[1].isdigit():
+				SWEEP = int(var[1])
+			elif var[0]=='hold' and var[1].isdigit():
+				HOLD = int(var[1])
+			elif var[0]=='log_queue' and var[1].isdigit():
+				LOG_QUEUE = int(var[1])
+			elif var[0]=='log_sample' and var[1].isdigit() and int(var[1]) > 0:
+				# log_sample=N : un message sur N pour tous les modes concernés
+				LOG_SAMPLE = dict.fromkeys(['select','sent','update'], int(var[1]))
+			elif var[0]=='log_sample' and ':' in var[1]:
+				# log_sample=select:10,sent:5 : taux par mode
+				for rate in var[1].split(','):
+					mode, n = rate.split(':',1)
+					if n.isdigit() and int(n) > 0:
+						LOG_SAMPLE[mode] = int(n)
+			elif var[0]=='port' and var[1].isdigit():
+				PORT = int(var[1])
+			elif var[0]=='workers' and var[1].isdigit():
+				WORKERS = int(var[1])
+			elif var[0]=='etat':
+				ETAT = var[1]
+			elif var[0]=='worker_fd' and var[1].isdigit():
+				WORKER_FD = int(var[1])
+			elif var[0] in ['rate','rate_ip'] and var[1].replace('.','',1).isdigit():
+				# requettes par seconde autorisées par code joueur / par IP
+				LIMITS[var[0]] = float(var[1])
+			elif var[0] in ['burst','burst_ip','ban_after','ban_time'] and var[1].isdigit():
+				LIMITS[var[0]] = int(var[1])
+			elif var[0]=='snapshot':
+				SNAPSHOT = var[1]
+			elif var[0]=='snapshot_every' and var[1].isdigit():
+				SNAPSHOT_EVERY = int(var[1])
+			elif var[0] in ['pkm_max','pkm_total','pkm_slots'] and var[1].isdigit():
+				POKEMONS[{'pkm_max': 'max_size', 'pkm_total': 'max_total', 'pkm_slots': 'slots'}[var[0]]] = int(var[1])
+			elif var[0]=='pkm_spill':
+				POKEMONS['spill'] = var[1]
+			elif var[0]=='compression' and var[1].isdigit():
+				COMPRESSION = int(var[1])
+			elif var[0]=='journal':
+				JOURNAL = var[1]
+			elif var[0] in ['max_players','retry_after'] and var[1].isdigit():
+				ADMISSION[var[0]] = int(var[1])
+			elif var[0]=='max_lag' and var[1].isdigit():
+				# retard max du reactor en millisecondes
+				ADMISSION['max_lag'] = int(var[1]) / 1000.0
+			elif var[0]=='capture':
+				CAPTURE = var[1]
+			elif var[0]=='moteur' and var[1] in ['web','brut']:
+				MOTEUR = var[1]
+			elif var[0]=='passation':
+				PASSATION = var[1]
 			else:
 				print "Argument Invalide !", arg
 		else:
 			print "Argument Invalide !", arg
 	
-	# Lancement du serveur à la page index.php et sur le port 80 (fixé par le jeu)
-	root = Resource()
-	root.putChild("index.php", Serveur(TIMEOUT,LOG_CONF,CHECK_AUTO,MASTER_CODE))
-	factory = Site(root)
-	reactor.listenTCP(80, factory)
+	# Worker lancé par spawn_workers : pas d'état, il relaie tout
+	if WORKER_FD is not None:
+		run_worker(WORKER_FD, ETAT, LOG_CONF, LOG_QUEUE, LOG_SAMPLE, COMPRESSION)
+		return
+	
+	# Les workers servent le HTTP avec twisted.web et tiennent la socket d'écoute
+	if WORKERS > 0 and (PASSATION or MOTEUR != 'web'):
+		print "Arguments incompatibles : workers=%s ne marche pas avec %s" % (WORKERS, ' ni '.join(
+			[arg for arg, used in [('passation', PASSATION), ('moteur=' + MOTEUR, MOTEUR != 'web')] if used]))
+		sys.exit(1)
+	
+	serveur = Serveur(TIMEOUT,LOG_CONF,CHECK_AUTO,MASTER_CODE,SWEEP,HOLD,log_queue=LOG_QUEUE,log_sample=LOG_SAMPLE,limits=LIMITS,pokemons=POKEMONS,journal=JOURNAL,compression=COMPRESSION,capture=CAPTURE,admission=ADMISSION)
+	if SNAPSHOT:
+		# Reprise à chaud : les clients retrouvent leur état au lieu de tous se reconnecter
+		serveur.restore(SNAPSHOT)
+		serveur.start_snapshots(SNAPSHOT, SNAPSHOT_EVERY)
+	# Ecoute en place (None si le port est pris : on sort en erreur après avoir vidé le log)
+	ecoute = None
+	if WORKERS > 0:
+		# Les workers décodent le HTTP, l'état reste dans ce processus
+		try:
+			ecoute = spawn_workers(serveur, WORKERS, PORT, ETAT,
+				[arg for arg in sys.argv[1:] if arg.split('=')[0] in ('log_conf', 'log_queue', 'log_sample', 'compression')])
+		except (socket.error, CannotListenError) as e:
+			serveur.logger.critical("Ecoute impossible sur le port %s : %s", PORT, e)
+			reactor.callWhenRunning(reactor.stop)
+	else:
+		# Lancement du serveur à la page index.php et sur le port 80 (fixé par le jeu)
+		if MOTEUR == 'brut':
+			factory = MoteurBrut(serveur)
+		else:
+			root = Resource()
+			root.putChild("index.php", serveur)
+			factory = SiteSuivi(root) if PASSATION else Site(root)
+		if PASSATION:
+			# Reprend la socket et l'état du processus en place s'il y en a un
+			ecoute = Passation(serveur, factory, PASSATION)
+			ecoute.start(PORT)
+		else:
+			try:
+				ecoute = reactor.listenTCP(PORT, factory)
+			except CannotListenError as e:
+				serveur.logger.critical("Ecoute impossible sur le port %s : %s", PORT, e.socketError)
+				reactor.callWhenRunning(reactor.stop)
 	reactor.run()
+	if ecoute is None or (PASSATION and ecoute.port is None):
+		sys.exit(1)
 
 
 if __name__ == '__main__':